@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+AP计算, speculate_confidence与pascal_voc_eval共用
+
+method:
+    'all':   所有点插值(precision取右侧最大值的包络后对recall积分)
+    'voc07': VOC2007的11点插值, recall阈值为 0, 0.1, ..., 1.0
+    整数N:   在 np.linspace(0, 1, N) 的N个recall阈值上取插值precision的平均, 如COCO的101点
+
+precision包络用 np.maximum.accumulate 从右往左一次得到, 多条曲线补齐成二维数组后一起计算,
+每条曲线的结果与逐点循环的实现逐位相同。
+"""
+import numpy as np
+
+
+def precision_envelope(mpre):
+    """
+    mpre[..., i] = max(mpre[..., i:]), 沿最后一维
+    """
+    return np.maximum.accumulate(mpre[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _pad(array_list, pad_value):
+    length = max([len(i) for i in array_list] + [0])
+    padded = np.full((len(array_list), length), pad_value, dtype=np.float64)
+    for row, array in enumerate(array_list):
+        padded[row, :len(array)] = array
+    return padded
+
+
+def _all_point_ap(rec_list, prec_list):
+    # 两端加哨兵, 右侧补齐部分recall保持1、precision为0, 不影响包络与积分
+    rec = _pad(rec_list, 1.)
+    prec = _pad(prec_list, 0.)
+    mrec = np.concatenate((np.zeros((len(rec), 1)), rec, np.ones((len(rec), 1))), axis=1)
+    mpre = np.concatenate((np.zeros((len(prec), 1)), prec, np.zeros((len(prec), 1))), axis=1)
+    mpre = precision_envelope(mpre)
+
+    ap_list = []
+    for row in range(len(rec_list)):
+        # look for recall value changes, sum (\delta recall) * prec
+        i = np.where(mrec[row, 1:] != mrec[row, :-1])[0]
+        ap_list.append(np.sum((mrec[row, i + 1] - mrec[row, i]) * mpre[row, i + 1]))
+    return np.array(ap_list, dtype=np.float64)
+
+
+def _n_point_ap(rec_list, prec_list, recall_thresholds):
+    # 补齐位置recall为-inf, 不会满足 rec >= t
+    rec = _pad(rec_list, -np.inf)
+    prec = _pad(prec_list, 0.)
+    order = np.argsort(rec, axis=1, kind='stable')
+    sorted_rec = np.take_along_axis(rec, order, axis=1)
+    # 按recall升序后取右侧最大值, 即 max(prec[rec >= t])
+    suffix_max = precision_envelope(np.take_along_axis(prec, order, axis=1))
+    point_num = len(recall_thresholds)
+    p = np.zeros((len(rec_list), point_num), dtype=np.float64)
+    for row in range(len(rec_list)):
+        index = np.searchsorted(sorted_rec[row], recall_thresholds, side='left')
+        found = index < sorted_rec.shape[1]
+        p[row, found] = suffix_max[row, index[found]]
+    # 与逐点累加 ap += p / N 的顺序一致
+    return np.cumsum(p / float(point_num), axis=1)[:, -1] if point_num else np.zeros(len(rec_list))
+
+
+def batch_average_precision(rec_list, prec_list, method='all'):
+    """
+    一次计算多条曲线的AP
+    :param rec_list: 每条曲线的recall
+    :param prec_list: 每条曲线的precision
+    :param method: 'all', 'voc07' 或插值点数N
+    :return: 与曲线条数等长的AP数组
+    """
+    rec_list = [np.asarray(i, dtype=np.float64).ravel() for i in rec_list]
+    prec_list = [np.asarray(i, dtype=np.float64).ravel() for i in prec_list]
+    if not rec_list:
+        return np.zeros(0)
+    if method == 'all':
+        return _all_point_ap(rec_list, prec_list)
+    if method == 'voc07':
+        return _n_point_ap(rec_list, prec_list, np.arange(0., 1.1, 0.1))
+    return _n_point_ap(rec_list, prec_list, np.linspace(0., 1., int(method)))
+
+
+def average_precision(rec, prec, method='all'):
+    return batch_average_precision([rec], [prec], method)[0]
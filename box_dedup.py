@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+重叠切块造成的重复框去除, 在读取每张slide的检测结果时执行一次
+
+规则按label配置, 'default'用于未单独配置的label, 没有规则的label保持不变:
+    {'default': {'method': 'nms', 'iou': 0.5}, 'ec': {'method': 'merge', 'iou': 0.3, 'min_score': 0.1}}
+    method:    nms   保留置信度最高的框, 与其IoU > iou的低置信度框去除(贪心NMS)
+               merge 同NMS分组, 保留框的坐标替换为组内框按置信度加权的平均, 置信度不变
+    iou:       IoU阈值
+    min_score: 先去除置信度低于该值的框
+
+NMS用box_overlap的扫描只找出相交的框对, 再按轮次向量化求解: 每轮中没有存活的更高置信度重叠框的框
+一定被保留, 它们的重叠框被去除, 结果与逐个框的贪心NMS相同。
+去重后的结果可按 pkl文件名、修改时间、大小与规则 保存在cache目录中, 再次读取时不需要解开pkl。
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from box_overlap import overlap_pairs_iou
+
+EMPTY_BOXES = np.zeros((0, 5), dtype=np.float64)
+
+DEFAULT_DEDUP_RULE = {
+    'method': 'nms',
+    'iou': 0.5,
+    'min_score': 0.,
+}
+
+
+def get_dedup_rule(dedup_rules, label):
+    """
+    :return: label对应的规则, 没有规则时为None
+    """
+    if not dedup_rules:
+        return None
+    rule = dedup_rules.get(label, dedup_rules.get('default'))
+    if rule is None:
+        return None
+    dedup_rule = dict(DEFAULT_DEDUP_RULE)
+    dedup_rule.update(rule)
+    if dedup_rule['method'] not in ('nms', 'merge'):
+        raise Exception('Unknown dedup method {}'.format(dedup_rule['method']))
+    return dedup_rule
+
+
+def nms(boxes, iou_threshold):
+    """
+    :param boxes: (N, 5), 按置信度降序
+    :return: 保留框的下标(升序), 以及每个框所属保留框的下标(保留框为自身)
+    """
+    box_num = len(boxes)
+    keeper = np.arange(box_num)
+    if box_num == 0:
+        return keeper, keeper
+    i, j, iou = overlap_pairs_iou(boxes[:, :4], boxes[:, :4])
+    # 只保留 i 排在 j 前面(置信度更高)且IoU超过阈值的框对
+    keep = (i < j) & (iou > iou_threshold)
+    i, j = i[keep], j[keep]
+
+    alive = np.ones(box_num, dtype=bool)
+    kept = np.zeros(box_num, dtype=bool)
+    while alive.any():
+        both_alive = alive[i] & alive[j]
+        has_higher = np.zeros(box_num, dtype=bool)
+        has_higher[j[both_alive]] = True
+        new_kept = alive & ~has_higher
+        kept |= new_kept
+        alive &= ~new_kept
+        # 与本轮保留框重叠的框被去除
+        alive[j[new_kept[i]]] = False
+    # 贪心NMS中被去除的框归入与其重叠的保留框中置信度最高(下标最小)的一个
+    from_kept = kept[i] & ~kept[j]
+    suppressed = np.full(box_num, box_num)
+    np.minimum.at(suppressed, j[from_kept], i[from_kept])
+    removed = suppressed < box_num
+    keeper[removed] = suppressed[removed]
+    return np.where(kept)[0], keeper
+
+
+def dedup_boxes(regions, dedup_rule):
+    """
+    :param regions: (N, 5) [x1, y1, x2, y2, confidence]
+    :return: 去重后的 (M, 5) float64数组, 按置信度降序
+    """
+    boxes = np.array(regions, dtype=np.float64).reshape((-1, 5)) if len(regions) else EMPTY_BOXES
+    boxes = boxes[boxes[:, 4] >= dedup_rule['min_score']]
+    boxes = boxes[np.argsort(-boxes[:, 4], kind='stable')]
+    kept_index, keeper = nms(boxes, dedup_rule['iou'])
+    if dedup_rule['method'] == 'merge' and len(boxes):
+        weight = np.bincount(keeper, weights=boxes[:, 4], minlength=len(boxes))
+        merged = boxes.copy()
+        for column in range(4):
+            merged[:, column] = np.bincount(keeper, weights=boxes[:, column] * boxes[:, 4],
+                                            minlength=len(boxes)) / np.maximum(weight, np.finfo(np.float64).eps)
+        # 置信度为0的组保持原坐标
+        merged[weight <= 0, :4] = boxes[weight <= 0, :4]
+        return merged[kept_index]
+    return boxes[kept_index]
+
+
+def dedup_result(result, dedup_rules):
+    """
+    :param result: {label: regions}, 单张slide的检测结果
+    :return: {label: regions}, 有规则的label为去重后的数组, 其它label不变
+    """
+    new_result = {}
+    for label, regions in result.items():
+        dedup_rule = get_dedup_rule(dedup_rules, label)
+        new_result[label] = regions if dedup_rule is None else dedup_boxes(regions, dedup_rule)
+    return new_result
+
+
+def _dedup_cache_path(cache_directory, pkl_path, dedup_rules):
+    stat = os.stat(pkl_path)
+    content = json.dumps({'pkl': os.path.abspath(pkl_path), 'mtime': stat.st_mtime, 'size': stat.st_size,
+                          'rules': dedup_rules}, sort_keys=True)
+    return os.path.join(cache_directory, hashlib.sha1(content.encode('utf-8')).hexdigest() + '.npz')
+
+
+def load_dedup_result(pkl_path, dedup_rules, cache_directory=''):
+    """
+    读取单个pkl并去重, cache_directory不为空时读写去重结果的cache
+    :return: {label: (N, 5) float64数组}, 没有规则时为原pkl内容
+    """
+    if not dedup_rules:
+        with open(pkl_path, 'rb') as f:
+            return pickle.load(f)
+    cache_path = _dedup_cache_path(cache_directory, pkl_path, dedup_rules) if cache_directory else ''
+    if cache_path and os.path.isfile(cache_path):
+        with np.load(cache_path, allow_pickle=False) as data:
+            return {label: data['boxes_{}'.format(index)] for index, label in enumerate(data['labels'].tolist())}
+
+    with open(pkl_path, 'rb') as f:
+        result = dedup_result(pickle.load(f), dedup_rules)
+    result = {label: np.array(regions, dtype=np.float64).reshape((-1, 5)) if len(regions) else EMPTY_BOXES
+              for label, regions in result.items()}
+    if cache_path:
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory, exist_ok=True)
+        labels = list(result.keys())
+        arrays = {'boxes_{}'.format(index): result[label] for index, label in enumerate(labels)}
+        tmp_path = cache_path + '.tmp.{}.npz'.format(os.getpid())
+        np.savez(tmp_path, labels=np.array(labels, dtype=str), **arrays)
+        os.replace(tmp_path, cache_path)
+    return result
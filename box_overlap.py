@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+基于x方向排序扫描的框相交查找
+
+把医生框按xmin排序, 与某个检测框可能相交的医生框的xmin一定落在
+(det_xmin - 最大医生框宽度, det_xmax) 之间, 用searchsorted得到候选区间后只对候选对计算相交。
+候选对分块展开, 内存与框个数(及实际相交对数)成线性, 不再分配 N_det x N_gt x 4 的数组。
+相交判断与原来的广播实现逐元素一致: w = max(min(x2) - max(x1), 0), h同理, w * h > 0。
+"""
+import numpy as np
+
+MAX_CANDIDATES = 1 << 22
+
+
+def _as_boxes(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if boxes.size == 0:
+        return np.zeros((0, 4))
+    return boxes.reshape((len(boxes), -1))[:, :4]
+
+
+def _intersection(det_boxes, gt_boxes):
+    xmin = np.maximum(gt_boxes[:, 0], det_boxes[:, 0])
+    ymin = np.maximum(gt_boxes[:, 1], det_boxes[:, 1])
+    xmax = np.minimum(gt_boxes[:, 2], det_boxes[:, 2])
+    ymax = np.minimum(gt_boxes[:, 3], det_boxes[:, 3])
+    w = np.maximum(xmax - xmin, 0.)
+    h = np.maximum(ymax - ymin, 0.)
+    return w * h
+
+
+def candidate_ranges(det_boxes, gt_boxes):
+    """
+    :return: 医生框按xmin排序后的下标order, 以及每个检测框的候选区间[lo, hi)
+    """
+    order = np.argsort(gt_boxes[:, 0], kind='stable')
+    sorted_xmin = gt_boxes[order, 0]
+    max_width = max(float(np.max(gt_boxes[:, 2] - gt_boxes[:, 0])), 0.)
+    # 留出浮点误差的余量, 候选只需要是相交对的超集
+    margin = 1e-6 * (1. + np.abs(det_boxes[:, 0]) + max_width)
+    lo = np.searchsorted(sorted_xmin, det_boxes[:, 0] - max_width - margin, side='left')
+    hi = np.searchsorted(sorted_xmin, det_boxes[:, 2], side='left')
+    return order, lo, np.maximum(hi, lo)
+
+
+def overlap_pairs(det_boxes, gt_boxes, return_inter=False, max_candidates=MAX_CANDIDATES):
+    """
+    找出所有相交面积 > 0 的(检测框, 医生框)对
+    :param det_boxes: (N, 4) 或 (N, 5), 只使用前4列
+    :param gt_boxes: (M, 4)
+    :param return_inter: 是否同时返回相交面积
+    :param max_candidates: 每块最多展开的候选对个数
+    :return: det_index, gt_index (, inter), 按det_index升序
+    """
+    det_boxes = _as_boxes(det_boxes)
+    gt_boxes = _as_boxes(gt_boxes)
+    det_index_list, gt_index_list, inter_list = [], [], []
+    if len(det_boxes) and len(gt_boxes):
+        order, lo, hi = candidate_ranges(det_boxes, gt_boxes)
+        lengths = hi - lo
+        cumulative = np.cumsum(lengths)
+        start = 0
+        while start < len(det_boxes):
+            # 每块的候选对总数不超过max_candidates(单个检测框的候选超过时该块只含这一个检测框)
+            base = cumulative[start] - lengths[start]
+            end = max(int(np.searchsorted(cumulative, base + max_candidates, side='right')), start + 1)
+            chunk_lengths = lengths[start:end]
+            total = int(chunk_lengths.sum())
+            if total:
+                det_index = np.repeat(np.arange(start, end), chunk_lengths)
+                chunk_offsets = np.cumsum(chunk_lengths) - chunk_lengths
+                position = np.arange(total) - np.repeat(chunk_offsets - lo[start:end], chunk_lengths)
+                gt_index = order[position]
+                inter = _intersection(det_boxes[det_index], gt_boxes[gt_index])
+                keep = inter > 0
+                det_index_list.append(det_index[keep])
+                gt_index_list.append(gt_index[keep])
+                inter_list.append(inter[keep])
+            start = end
+
+    det_index = np.concatenate(det_index_list) if det_index_list else np.zeros(0, dtype=np.int64)
+    gt_index = np.concatenate(gt_index_list) if gt_index_list else np.zeros(0, dtype=np.int64)
+    if return_inter:
+        inter = np.concatenate(inter_list) if inter_list else np.zeros(0)
+        return det_index, gt_index, inter
+    return det_index, gt_index
+
+
+def box_area(boxes):
+    boxes = _as_boxes(boxes)
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def overlap_pairs_iou(det_boxes, gt_boxes, max_candidates=MAX_CANDIDATES):
+    """
+    相交的框对及其IoU, 面积与相交面积的算法与overlap_pairs一致(不加1)
+    :return: det_index, gt_index, iou
+    """
+    det_index, gt_index, inter = overlap_pairs(det_boxes, gt_boxes, True, max_candidates)
+    union = box_area(det_boxes)[det_index] + box_area(gt_boxes)[gt_index] - inter
+    return det_index, gt_index, inter / np.maximum(union, np.finfo(np.float64).eps)
+
+
+def greedy_match(det_index, gt_index, iou, iou_threshold=0.):
+    """
+    一对一贪心匹配: 检测框按下标从小到大(即优先级从高到低)依次匹配,
+    每个检测框取尚未被匹配、IoU >= iou_threshold 的医生框中IoU最大的一个
+    :return: 匹配上的det_index, gt_index, 按det_index升序
+    """
+    keep = iou >= iou_threshold
+    det_index, gt_index, iou = det_index[keep], gt_index[keep], iou[keep]
+    # 同一检测框内IoU从大到小
+    order = np.lexsort((-iou, det_index))
+    det_index, gt_index = det_index[order], gt_index[order]
+    matched_det, matched_gt, used_gt = [], [], set()
+    current_det = -1
+    for det, gt in zip(det_index.tolist(), gt_index.tolist()):
+        if det == current_det or gt in used_gt:
+            continue
+        current_det = det
+        used_gt.add(gt)
+        matched_det.append(det)
+        matched_gt.append(gt)
+    return np.array(matched_det, dtype=np.int64), np.array(matched_gt, dtype=np.int64)
+
+
+def coincide_region_num(det_boxes, gt_boxes):
+    """
+    与逐对比较检测框和医生框的原实现相同的计数
+    :return: TP1(与任一医生框相交的检测框数), TP2(被任一检测框相交的医生框数), FP, FN
+    """
+    det_index, gt_index = overlap_pairs(det_boxes, gt_boxes)
+    TP1 = len(np.unique(det_index))
+    TP2 = len(np.unique(gt_index))
+    FP = len(det_boxes) - TP1
+    FN = len(gt_boxes) - TP2
+    return TP1, TP2, FP, FN
@@ -1,10 +1,22 @@
 import argparse
 import os
-import pickle
+import sys
 
 import yaml
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from box_dedup import dedup_result, load_dedup_result
+from detection_store import DetectionStore
+
 confidence = -1
+# 读取pkl时的重复框去除规则与cache目录, 见box_dedup.py
+dedup = {'rules': {}, 'cache_directory': ''}
+# 不为空时代替pkl文件夹读取, 每个子文件夹对应其中的 <子文件夹名>.store, 由detection_store.py打包
+detection_store_directory = ''
+# {子文件夹名: DetectionStore}
+detection_stores = {}
+
+STORE_SUFFIX = '.store'
 
 
 def scan_pickle_sub_folder(pickle_file_directory):
@@ -24,18 +36,39 @@ def scan_pickle_file(directory_path):
     return file_list
 
 
+def scan_detection_store_sub_folder(store_directory):
+    if not os.path.isdir(store_directory):
+        raise Exception('No such detection_store_directory')
+    return [file[:-len(STORE_SUFFIX)] for file in os.listdir(store_directory) if file.endswith(STORE_SUFFIX)]
+
+
+def get_detection_store(sub_folder):
+    if sub_folder not in detection_stores:
+        detection_stores[sub_folder] = DetectionStore(os.path.join(detection_store_directory,
+                                                                   sub_folder + STORE_SUFFIX))
+    return detection_stores[sub_folder]
+
+
+def load_result(pickle_file_path):
+    if detection_store_directory:
+        # 打包文件中按 子文件夹/pkl文件名 取出, 框为float32数组
+        sub_folder_path, pickle = os.path.split(pickle_file_path)
+        result = get_detection_store(os.path.basename(sub_folder_path)).slide_result(pickle)
+        return dedup_result(result, dedup['rules'])
+    return load_dedup_result(pickle_file_path, dedup['rules'], dedup['cache_directory'])
+
+
 def calc_annotation_num(pickle_file_path, label):
-    with open(pickle_file_path, 'rb') as f:
-        result = pickle.load(f)
-        label_list = result.get(label, [])
-        label_list = sorted(label_list, key=lambda x: x[-1])
-        init_index = 0
-        for index, value in enumerate(label_list):
-            if value[-1] > confidence:
-                init_index = index
-                break
-        label_list = label_list[init_index:]
-        return len(label_list)
+    result = load_result(pickle_file_path)
+    label_list = result.get(label, [])
+    label_list = sorted(label_list, key=lambda x: x[-1])
+    init_index = 0
+    for index, value in enumerate(label_list):
+        if value[-1] > confidence:
+            init_index = index
+            break
+    label_list = label_list[init_index:]
+    return len(label_list)
 
 
 def analyze_threshold(result_list, init_index, highest_sensitivity):
@@ -137,7 +170,10 @@ def calc_threshold_dict(root_directory, trim_sub_folder_list, highest_sensitivit
     threshold_dict = {}
     for index, sub_folder in enumerate(trim_sub_folder_list):
         sub_folder_path = os.path.join(root_directory, sub_folder)
-        pickle_files = scan_pickle_file(sub_folder_path)
+        if detection_store_directory:
+            pickle_files = get_detection_store(sub_folder).slides
+        else:
+            pickle_files = scan_pickle_file(sub_folder_path)
         # 优先级最高
         if index == 0:
             label_num_list = get_senior_label_num_list(sub_folder_path, pickle_files)
@@ -168,7 +204,12 @@ if __name__ == '__main__':
     grade_label_list = args.grade_label_list
     highest_sensitivity = args.highest_sensitivity
     confidence = args.confidence
-    sub_folder_list = scan_pickle_sub_folder(root_directory)
+    dedup = args.dedup
+    detection_store_directory = args.detection_store_directory
+    if detection_store_directory:
+        sub_folder_list = scan_detection_store_sub_folder(detection_store_directory)
+    else:
+        sub_folder_list = scan_pickle_sub_folder(root_directory)
     # 根据优先级整理子文件夹
     trim_sub_folder_list = trim_sub_folder_by_label_grade(sub_folder_list, grade_label_list)
     # 求阈值
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+VOC检测结果文件(每行 image_id confidence x1 y1 x2 y2)的快速读取与二进制格式
+
+文本文件按块读取, 每块在字节数组上向量化处理: 由换行和每行第一个空格的位置取出image_id,
+np.unique得到整数编码; image_id替换为空格后其余部分用np.fromstring一次解析为float64,
+与逐个float()的结果逐位相同。格式不符合(空行、字段个数不对等)的块按原来的逐行方式解析。
+
+二进制格式与detection_store相同: MAGIC | uint64 header长度 | header(json) | 按64字节对齐的各数组
+    header['image_names']: image_id列表
+    image_codes: int64 (N,), image_names中的下标
+    confidence:  float64 (N,)
+    bbox:        float64 (N, 4)
+读取时只做np.memmap, 检测框保持文件中的顺序。
+用法: python detection_file.py det.txt det.bin
+"""
+import argparse
+import warnings
+
+import numpy as np
+
+try:
+    from .detection_store import read_packed_file, write_packed_file
+except ImportError:
+    from detection_store import read_packed_file, write_packed_file
+
+MAGIC = b'VOCDET1'
+CHUNK_SIZE = 64 << 20
+
+
+def _parse_lines(data):
+    """
+    原来的逐行解析, 用于格式不规则的块
+    """
+    splitlines = [x.strip().split(' ') for x in data.decode('utf-8').splitlines()]
+    image_ids = [x[0] for x in splitlines]
+    confidence = np.array([float(x[1]) for x in splitlines])
+    bbox = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape((-1, 4))
+    image_names, image_codes = np.unique(np.array(image_ids, dtype=object), return_inverse=True)
+    return list(image_names), image_codes, confidence, bbox
+
+
+def _parse_chunk(data):
+    """
+    :param data: 以完整行组成的bytes
+    :return: 本块的image_id列表, 编码, confidence, bbox
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == ord('\n'))
+    if len(line_ends) == 0 or line_ends[-1] != len(buf) - 1:
+        line_ends = np.r_[line_ends, len(buf)]
+    line_starts = np.r_[0, line_ends[:-1] + 1]
+    spaces = np.flatnonzero(buf == ord(' '))
+    first_space = np.searchsorted(spaces, line_starts)
+    if np.any(first_space >= len(spaces)):
+        return _parse_lines(data)
+    first_space = spaces[first_space]
+    id_lengths = first_space - line_starts
+    if np.any(first_space >= line_ends) or np.any(id_lengths == 0):
+        return _parse_lines(data)
+
+    # 每行的image_id按最长长度补齐成定长bytes
+    max_length = int(id_lengths.max())
+    column = np.arange(max_length)
+    in_id = column[None, :] < id_lengths[:, None]
+    id_bytes = np.zeros((len(line_starts), max_length), dtype=np.uint8)
+    id_bytes[in_id] = buf[(line_starts[:, None] + column[None, :])[in_id]]
+    image_names, image_codes = np.unique(id_bytes.view('S{}'.format(max_length)).ravel(), return_inverse=True)
+
+    # image_id替换为空格后只剩数字
+    in_id_mask = np.zeros(len(buf) + 1, dtype=np.int64)
+    np.add.at(in_id_mask, line_starts, 1)
+    np.add.at(in_id_mask, first_space, -1)
+    numbers = buf.copy()
+    numbers[np.cumsum(in_id_mask[:-1]) > 0] = ord(' ')
+    # 不能完整解析时numpy按版本给出DeprecationWarning或ValueError, 都改为逐行解析
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(numbers.tobytes().decode('ascii', 'replace'), dtype=np.float64, sep=' ')
+    except ValueError:
+        return _parse_lines(data)
+    if len(values) != 5 * len(line_starts):
+        return _parse_lines(data)
+    values = values.reshape((-1, 5))
+    return [name.decode('utf-8') for name in image_names], image_codes, values[:, 0], values[:, 1:]
+
+
+def _iter_line_chunks(f, chunk_size):
+    """
+    按块读取, 每块在最后一个换行处截断, 剩余部分并入下一块
+    """
+    rest = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        data, rest = data[:cut], data[cut:]
+        if data:
+            yield data
+    # 最后一行没有换行
+    if rest.strip():
+        yield rest
+
+
+def read_detection_text(detfile, chunk_size=CHUNK_SIZE):
+    """
+    :return: image_names, image_codes(int64), confidence(float64), bbox(float64, (N, 4)), 按文件中的顺序
+    """
+    name_index = {}
+    code_list, confidence_list, bbox_list = [], [], []
+    with open(detfile, 'rb') as f:
+        for data in _iter_line_chunks(f, chunk_size):
+            chunk_names, chunk_codes, confidence, bbox = _parse_chunk(data)
+            # 本块的编码换成全文件的编码
+            remap = np.array([name_index.setdefault(name, len(name_index)) for name in chunk_names], dtype=np.int64)
+            code_list.append(remap[chunk_codes])
+            confidence_list.append(confidence)
+            bbox_list.append(bbox)
+
+    image_names = sorted(name_index, key=name_index.get)
+    if not code_list:
+        return image_names, np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 4))
+    return (image_names, np.concatenate(code_list).astype(np.int64), np.concatenate(confidence_list),
+            np.concatenate(bbox_list))
+
+
+def write_detection_binary(binary_path, image_names, image_codes, confidence, bbox):
+    arrays = [('image_codes', np.asarray(image_codes, dtype=np.int64)),
+              ('confidence', np.asarray(confidence, dtype=np.float64)),
+              ('bbox', np.asarray(bbox, dtype=np.float64).reshape((-1, 4)))]
+    write_packed_file(binary_path, MAGIC, {'image_names': list(image_names)}, arrays)
+
+
+def read_detection_binary(binary_path):
+    """
+    :return: 与read_detection_text相同, 数组为np.memmap
+    """
+    header, arrays = read_packed_file(binary_path, MAGIC)
+    return header['image_names'], arrays['image_codes'], arrays['confidence'], arrays['bbox']
+
+
+def is_detection_binary(detfile):
+    with open(detfile, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_detection_file(detfile):
+    """
+    按文件头自动选择二进制或文本格式
+    """
+    if is_detection_binary(detfile):
+        return read_detection_binary(detfile)
+    return read_detection_text(detfile)
+
+
+def convert_detection_file(detfile, binary_path):
+    """
+    文本检测结果转为二进制格式
+    :return: 检测框个数
+    """
+    image_names, image_codes, confidence, bbox = read_detection_text(detfile)
+    write_detection_binary(binary_path, image_names, image_codes, confidence, bbox)
+    return len(confidence)
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('detfile', type=str, help='text detection results')
+    parser.add_argument('binary_path', type=str, help='output binary file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arg()
+    box_num = convert_detection_file(args.detfile, args.binary_path)
+    print('{} boxes -> {}'.format(box_num, args.binary_path))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+将每张slide一个的检测结果pkl目录打包成单个列存文件, 并以内存映射方式读取
+
+文件格式:
+    MAGIC | uint64 header长度 | header(json) | 按64字节对齐的各数组
+
+    boxes:   float32 (N, 5), [x1, y1, x2, y2, confidence], 按label为主序、slide为次序排列
+    offsets: int64 (label_num * slide_num + 1,), 第l个label第s张slide的框为
+             boxes[offsets[l * slide_num + s]: offsets[l * slide_num + s + 1]]
+    present: uint8 (slide_num, label_num), 原pkl中是否存在该label
+
+同一label的所有框连续存放, 读取时只做np.memmap, 多个进程打开同一文件时共享page cache。
+用法: python detection_store.py pkl_file_directory store_path
+"""
+import argparse
+import json
+import os
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+
+MAGIC = b'DETSTORE1'
+ALIGN = 64
+
+
+def _get_pickle_file_list(pickle_directory):
+    pickle_file_list = []
+    for root, dirs, files in os.walk(pickle_directory):
+        for file in files:
+            if file.split('.')[-1].lower() == 'pkl':
+                pickle_file_list.append(file)
+    return pickle_file_list
+
+
+def _align(position):
+    return (position + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_packed_file(path, magic, header, arrays):
+    """
+    写出 magic | uint64 header长度 | header(json) | 按64字节对齐的各数组
+    :param header: 可json序列化的dict, 数组的dtype/shape/offset写入header['arrays']
+    :param arrays: [(name, array)]
+    """
+    header = dict(header, arrays={})
+    # 先用占位offset计算header长度, 再回填真实位置
+    position = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+    header_bytes = json.dumps(header).encode('utf-8')
+    position = _align(len(magic) + 8 + len(header_bytes) + 32 * len(arrays))
+    for name, array in arrays:
+        header['arrays'][name]['offset'] = position
+        position = _align(position + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    if arrays and len(magic) + 8 + len(header_bytes) > header['arrays'][arrays[0][0]]['offset']:
+        raise Exception('{} header overflow'.format(path))
+
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.seek(header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(position)
+
+
+def read_packed_file(path, magic):
+    """
+    :return: header, {name: np.memmap数组}, 空数组为np.zeros
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise Exception('{} is not a {} file'.format(path, magic.decode('ascii')))
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=info['dtype'], mode='r', offset=info['offset'], shape=shape)
+    return header, arrays
+
+
+def build_detection_store(pickle_file_directory, store_path, pkl_file_list=None):
+    """
+    读取pkl目录并写出打包文件
+    :param pickle_file_directory: pkl目录
+    :param store_path: 输出文件路径
+    :param pkl_file_list: 需要打包的pkl文件名, 为空时打包目录下所有pkl
+    :return: 打包的slide个数与框个数
+    """
+    if pkl_file_list is None:
+        pkl_file_list = sorted(_get_pickle_file_list(pickle_file_directory))
+    slide_label_boxes = []
+    label_set = set()
+    for file in pkl_file_list:
+        with open(os.path.join(pickle_file_directory, file), 'rb') as f:
+            result = pickle.load(f)
+        label_boxes = {}
+        for label, regions in result.items():
+            label_boxes[label] = np.array(regions, dtype=np.float32).reshape((-1, 5))
+            label_set.add(label)
+        slide_label_boxes.append(label_boxes)
+    labels = sorted(label_set)
+
+    slide_num, label_num = len(pkl_file_list), len(labels)
+    present = np.zeros((slide_num, label_num), dtype=np.uint8)
+    counts = np.zeros(label_num * slide_num, dtype=np.int64)
+    chunks = []
+    for l, label in enumerate(labels):
+        for s, label_boxes in enumerate(slide_label_boxes):
+            if label in label_boxes:
+                present[s, l] = 1
+                counts[l * slide_num + s] = len(label_boxes[label])
+                chunks.append(label_boxes[label])
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    boxes = np.concatenate(chunks) if chunks else np.zeros((0, 5), dtype=np.float32)
+
+    arrays = [('boxes', boxes), ('offsets', offsets), ('present', present)]
+    write_packed_file(store_path, MAGIC, {'slides': list(pkl_file_list), 'labels': labels}, arrays)
+    return slide_num, len(boxes)
+
+
+class DetectionStore:
+    """
+    打包文件的只读视图, 所有数组均为np.memmap, 取出的框为float32数组视图
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        header, arrays = read_packed_file(store_path, MAGIC)
+        self.slides = header['slides']
+        self.labels = header['labels']
+        self.slide_index = {slide: index for index, slide in enumerate(self.slides)}
+        self.label_index = {label: index for index, label in enumerate(self.labels)}
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.slides)
+
+    def _range(self, slide_index, label_index):
+        position = label_index * len(self.slides) + slide_index
+        return int(self.offsets[position]), int(self.offsets[position + 1])
+
+    def has_label(self, slide, label):
+        if label not in self.label_index:
+            return False
+        return bool(self.present[self.slide_index[slide], self.label_index[label]])
+
+    def slide_label_boxes(self, slide, label):
+        """
+        :return: 该slide该label的框, (n, 5)
+        """
+        start, end = self._range(self.slide_index[slide], self.label_index[label])
+        return self.boxes[start:end]
+
+    def label_boxes(self, label):
+        """
+        :return: 所有slide该label的框(连续存放), 以及每张slide在其中的起止offset
+        """
+        l = self.label_index[label]
+        slide_num = len(self.slides)
+        slide_offsets = np.asarray(self.offsets[l * slide_num: (l + 1) * slide_num + 1])
+        return self.boxes[slide_offsets[0]:slide_offsets[-1]], slide_offsets - slide_offsets[0]
+
+    def slide_result(self, slide):
+        """
+        :return: 与原pkl相同结构的{label: boxes}, 只包含原pkl中存在的label
+        """
+        s = self.slide_index[slide]
+        result = {}
+        for l, label in enumerate(self.labels):
+            if self.present[s, l]:
+                start, end = self._range(s, l)
+                result[label] = self.boxes[start:end]
+        return result
+
+    def results(self):
+        """
+        :return: 可替代 {pkl_file: result} 字典的只读映射, 访问时才取出对应slide
+        """
+        return StoreResults(self)
+
+
+class StoreResults(Mapping):
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, slide):
+        if slide not in self.store.slide_index:
+            raise KeyError(slide)
+        return self.store.slide_result(slide)
+
+    def __iter__(self):
+        return iter(self.store.slides)
+
+    def __len__(self):
+        return len(self.store.slides)
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pkl_file_directory', type=str, help='path to pkl_files')
+    parser.add_argument('store_path', type=str, help='output packed file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arg()
+    slide_num, box_num = build_detection_store(args.pkl_file_directory, args.store_path)
+    print('{} slides, {} boxes -> {}'.format(slide_num, box_num, args.store_path))
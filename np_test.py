@@ -33,3 +33,11 @@ print(tp_array_2)
 tp_array_2 = np.where(tp_array_2>0, 1, 0)
 tp_array_2 = np.sum(tp_array_2)
 print(tp_array_2)
+
+
+# 按x方向扫描只比较可能相交的框对, 结果与上面的广播计算一致
+from box_overlap import coincide_region_num, overlap_pairs
+
+det_index, gt_index = overlap_pairs(mc_bbox.reshape((-1, 4)), gt_bbox)
+print(det_index, gt_index)
+print(coincide_region_num(mc_bbox.reshape((-1, 4)), gt_bbox))
@@ -5,4 +5,6 @@ cls_config.check_model_path = "check.model"
 cls_config.cls_model_path = "cls.model"
 cls_config.feature_order = ['hsil', 'lsil','ec']
 cls_config.cls_order = ['hsil', 'lsil']
-cls_config.thresh = .1
\ No newline at end of file
+cls_config.thresh = .1
+# 重复框去除规则, 见box_dedup.py, 为空时不去重
+cls_config.dedup_rules = {}
@@ -1,9 +1,15 @@
 from sklearn.linear_model import LogisticRegression
 import numpy as np
+import os
 import pickle
+import sys
 
 from cls_config import cls_config
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from box_dedup import dedup_result
+from detection_store import DetectionStore
+
 def load_model(file_path):
     with open(file_path, 'rb') as f:
        clf = pickle.dump(f)
@@ -28,10 +34,14 @@ class img_cls_clf:
         self.feature_order = cls_config.feature_order
         self.cls_order = cls_config.cls_order
         self.thresh = cls_config.thresh
+        self.dedup_rules = cls_config.dedup_rules
 
     def infer(self, result):
         test_data = []
         x = []
+        # 重叠切块的重复框先去除, 再按框数分类
+        if self.dedup_rules:
+            result = dedup_result(result, self.dedup_rules)
         new_result = update_result(result)
         for s_feature in self.feature_order:
             x.append(len(new_result[s_feature]))
@@ -44,3 +54,8 @@ class img_cls_clf:
 
         cls_label_index = self.cls_clf.predict(test_data)[0]
         return self.cls_order[cls_label_index]
+
+    def infer_store(self, store_path):
+        # detection_store.py打包的文件, 每张slide取出的结果与pkl结构相同
+        detection_store = DetectionStore(store_path)
+        return {slide: self.infer(detection_store.slide_result(slide)) for slide in detection_store.slides}
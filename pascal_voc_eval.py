@@ -3,12 +3,24 @@ given a pascal voc imdb, compute mAP
 """
 
 from ..logger import logger
+from .average_precision import average_precision, batch_average_precision
+from .detection_file import read_detection_file
+from .detection_store import read_packed_file, write_packed_file
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
 import numpy as np
 import os
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import warnings
+
+# coco-style evaluation, see voc_eval_coco
+COCO_OVTHRESHOLDS = np.linspace(.5, .95, 10)
+COCO_AREA_RANGES = (('all', -np.inf, np.inf), ('small', 0., 32. ** 2), ('medium', 32. ** 2, 96. ** 2),
+                    ('large', 96. ** 2, np.inf))
+
+# columnar annotation cache, see load_annotations
+ANNOCACHE_MAGIC = b'VOCANNO1'
+ANNOCACHE_ARRAYS = ('file_mtime', 'file_size', 'boxes', 'image_index', 'class_code', 'difficult')
+
 
 def parse_voc_rec(filename):
     """
@@ -41,131 +53,294 @@ def voc_ap(rec, prec, use_07_metric=False):
     :param use_07_metric: 2007 metric is 11-recall-point based AP
     :return: average precision
     """
-    if use_07_metric:
-        ap = 0.
-        for t in np.arange(0., 1.1, 0.1):
-            if np.sum(rec >= t) == 0:
-                p = 0
-            else:
-                p = np.max(prec[rec >= t])
-            ap += p / 11.
-    else:
-        # append sentinel values at both ends
-        mrec = np.concatenate(([0.], rec, [1.]))
-        mpre = np.concatenate(([0.], prec, [0.]))
+    return average_precision(rec, prec, 'voc07' if use_07_metric else 'all')
 
-        # compute precision integration ladder
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
 
-        # look for recall value changes
-        i = np.where(mrec[1:] != mrec[:-1])[0]
+def image_overlaps(bb, bbgt):
+    """
+    IoU matrix between detections and ground truth boxes of one image, same arithmetic as the original loop
+    :param bb: [n_det, 4] float
+    :param bbgt: [n_gt, 4] float
+    :return: [n_det, n_gt] overlaps
+    """
+    # intersection
+    ixmin = np.maximum(bbgt[None, :, 0], bb[:, None, 0])
+    iymin = np.maximum(bbgt[None, :, 1], bb[:, None, 1])
+    ixmax = np.minimum(bbgt[None, :, 2], bb[:, None, 2])
+    iymax = np.minimum(bbgt[None, :, 3], bb[:, None, 3])
+    # 此处不需加一(for_myself)
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
 
-        # sum (\delta recall) * prec
-        ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
-    return ap
+    # union
+    uni = (((bb[:, 2] - bb[:, 0] + 1.) * (bb[:, 3] - bb[:, 1] + 1.))[:, None] +
+           ((bbgt[:, 2] - bbgt[:, 0] + 1.) *
+            (bbgt[:, 3] - bbgt[:, 1] + 1.))[None, :] - inters)
 
+    return inters / uni
 
-def voc_eval(detpath, annopath, imageset_file, classname, annocache, ovthresh=0.5, use_07_metric=False):
+
+def max_overlaps(image_codes, bbox, class_recs, max_matrix_size=1 << 22):
     """
-    pascal voc evaluation
-    :param detpath: detection results detpath.format(classname)
-    :param annopath: annotations annopath.format(classname)
-    :param imageset_file: text file containing list of images
-    :param classname: category name
-    :param annocache: caching annotations
-    :param ovthresh: overlap threshold
-    :param use_07_metric: whether to use voc07's 11 point ap computation
-    :return: rec, prec, ap
+    max overlap of each detection, the IoU matrix of every image is computed once
+    :param image_codes: index in the image set of each detection
+    :param bbox: [nd, 4] detections in the same order
+    :param class_recs: {'bbox': [n_gt, 4], 'difficult': [n_gt], 'offsets': [n_image + 1]},
+                       ground truth of image i is bbox[offsets[i]:offsets[i + 1]]
+    :param max_matrix_size: max elements of one IoU matrix, larger images are split by detections
+    :return: ovmax, gtmax (index in class_recs['bbox'], -1 for images without ground truth)
+    """
+    nd = len(image_codes)
+    image_codes = np.asarray(image_codes, dtype=np.int64)
+    offsets = class_recs['offsets']
+    ovmax = np.full(nd, -np.inf)
+    gtmax = np.full(nd, -1, dtype=np.int64)
+    if nd == 0:
+        return ovmax, gtmax
+
+    order = np.argsort(image_codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, image_codes[order][1:] != image_codes[order][:-1]])
+    ends = np.r_[starts[1:], nd]
+    for start, end in zip(starts, ends):
+        image_code = image_codes[order[start]]
+        gt_start, gt_end = offsets[image_code], offsets[image_code + 1]
+        if gt_end == gt_start:
+            continue
+        bbgt = class_recs['bbox'][gt_start:gt_end].astype(float)
+        det_inds = order[start:end]
+        step = max(1, max_matrix_size // len(bbgt))
+        for chunk_start in range(0, len(det_inds), step):
+            chunk = det_inds[chunk_start:chunk_start + step]
+            overlaps = image_overlaps(bbox[chunk, :].astype(float), bbgt)
+            jmax = np.argmax(overlaps, axis=1)
+            ovmax[chunk] = overlaps[np.arange(len(chunk)), jmax]
+            gtmax[chunk] = gt_start + jmax
+    return ovmax, gtmax
+
+
+def greedy_assign(ovmax, gtmax, ignore_gt, ovthresholds, ignore_det=None):
+    """
+    greedy assignment of score-sorted detections for several overlap thresholds at once
+    each detection takes its max-overlap ground truth; the first detection (in score order) on a ground truth above
+    the threshold is a true positive, later ones are false positives; detections on ignored ground truth, and
+    detections in ignore_det that are not a true positive (misses and duplicates), are neither
+    :param ignore_gt: bool per ground truth, e.g. difficult
+    :param ovthresholds: overlap thresholds
+    :param ignore_det: bool per detection, None for no ignored detection
+    :return: tp, fp of shape [len(ovthresholds), nd]
+    """
+    ovthresholds = np.asarray(ovthresholds, dtype=np.float64)
+    nd = len(ovmax)
+    tp = np.zeros((len(ovthresholds), nd))
+    fp = np.zeros((len(ovthresholds), nd))
+    if nd == 0:
+        return tp, fp
+    ignore_gt = np.asarray(ignore_gt, dtype=bool)
+    gt_ignored = np.zeros(nd, dtype=bool)
+    has_gt = gtmax >= 0
+    gt_ignored[has_gt] = ignore_gt[gtmax[has_gt]]
+
+    hit = ovmax[None, :] > ovthresholds[:, None]
+    fp[~hit] = 1.
+    # ignored ground truth: neither tp nor fp
+    threshold_inds, det_inds = np.nonzero(hit & ~gt_ignored[None, :])
+    # the first detection on each ground truth is tp, row-major order keeps score order within a threshold
+    _, first = np.unique(threshold_inds * (len(ignore_gt) + 1) + gtmax[det_inds], return_index=True)
+    fp[threshold_inds, det_inds] = 1.
+    fp[threshold_inds[first], det_inds[first]] = 0.
+    tp[threshold_inds[first], det_inds[first]] = 1.
+    if ignore_det is not None:
+        fp[:, np.asarray(ignore_det, dtype=bool)] = 0.
+    return tp, fp
+
+
+def voc_match(image_codes, bbox, class_recs, ovthresh=0.5, max_matrix_size=1 << 22):
     """
+    greedy matching of score-sorted detections, grouped by image
+    :param image_codes: index in the image set of each detection, sorted by descending confidence
+    other params are the same as max_overlaps
+    :return: tp, fp
+    """
+    ovmax, gtmax = max_overlaps(image_codes, bbox, class_recs, max_matrix_size)
+    tp, fp = greedy_assign(ovmax, gtmax, class_recs['difficult'], [ovthresh])
+    return tp[0], fp[0]
+
+
+def load_image_set(imageset_file):
     with open(imageset_file, 'r') as f:
         lines = f.readlines()
-    image_filenames = [x.strip() for x in lines]
+    return [x.strip() for x in lines]
 
-    # load annotations from cache
+
+def _parse_annotation(filename):
+    """
+    :return: object names, boxes and difficult flags of one xml
+    """
+    objects = parse_voc_rec(filename)
+    return ([x['name'] for x in objects], [x['bbox'] for x in objects], [x['difficult'] for x in objects])
+
+
+def read_annotation_cache(annocache, annopath):
+    """
+    :return: columnar annotations, None if annocache is missing, of an older format or built from another annopath
+    """
     if not os.path.isfile(annocache):
-        recs = {}
-        for ind, image_filename in enumerate(image_filenames):
-            recs[image_filename] = parse_voc_rec(annopath.format(image_filename))
-            if ind % 100 == 0:
-                logger.info('reading annotations for %d/%d' % (ind + 1, len(image_filenames)))
-        logger.info('saving annotations cache to %s' % annocache)
-        with open(annocache, 'wb') as f:
-            pickle.dump(recs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return None
+    with open(annocache, 'rb') as f:
+        if f.read(len(ANNOCACHE_MAGIC)) != ANNOCACHE_MAGIC:
+            return None
+    header, arrays = read_packed_file(annocache, ANNOCACHE_MAGIC)
+    if header['annopath'] != annopath:
+        return None
+    annotations = {'image_names': header['image_names'], 'class_names': header['class_names']}
+    annotations.update(arrays)
+    return annotations
+
+
+def write_annotation_cache(annocache, annopath, annotations):
+    arrays = [(name, annotations[name]) for name in ANNOCACHE_ARRAYS]
+    header = {'annopath': annopath, 'image_names': annotations['image_names'],
+              'class_names': annotations['class_names']}
+    tmp_path = annocache + '.tmp.%d' % os.getpid()
+    write_packed_file(tmp_path, ANNOCACHE_MAGIC, header, arrays)
+    os.replace(tmp_path, annocache)
+
+
+def load_annotations(annopath, image_filenames, annocache, processes=0):
+    """
+    load columnar annotations of all images
+    annocache records mtime and size of every xml, only new or changed xml are parsed (in a process pool)
+    :param processes: size of the process pool parsing xml, 0 for cpu_count()
+    :return: {'image_names': [n_image], 'class_names': [n_class],
+              'file_mtime': [n_image], 'file_size': [n_image],
+              'boxes': int32 [n_obj, 4], 'image_index': [n_obj], 'class_code': [n_obj], 'difficult': bool [n_obj]}
+    """
+    image_names = list(dict.fromkeys(image_filenames))
+    stats = [os.stat(annopath.format(image_name)) for image_name in image_names]
+    annotations = read_annotation_cache(annocache, annopath)
+    if annotations is None:
+        annotations = {'image_names': [], 'class_names': [],
+                       'file_mtime': np.zeros(0), 'file_size': np.zeros(0, dtype=np.int64),
+                       'boxes': np.zeros((0, 4), dtype=np.int32), 'image_index': np.zeros(0, dtype=np.int32),
+                       'class_code': np.zeros(0, dtype=np.int32), 'difficult': np.zeros(0, dtype=bool)}
+    cached_index = {image_name: ind for ind, image_name in enumerate(annotations['image_names'])}
+    cached_positions = np.array([cached_index.get(image_name, -1) for image_name in image_names], dtype=np.int64)
+    file_mtime = np.array([stat.st_mtime for stat in stats], dtype=np.float64)
+    file_size = np.array([stat.st_size for stat in stats], dtype=np.int64)
+    cached = cached_positions >= 0
+    unchanged = cached.copy()
+    unchanged[cached] = ((annotations['file_mtime'][cached_positions[cached]] == file_mtime[cached]) &
+                         (annotations['file_size'][cached_positions[cached]] == file_size[cached]))
+    changed = [(image_names[ind], stats[ind]) for ind in np.flatnonzero(~unchanged)]
+    if not changed:
+        return annotations
+
+    logger.info('reading annotations for %d/%d changed images' % (len(changed), len(image_names)))
+    filenames = [annopath.format(image_name) for image_name, _ in changed]
+    processes = min(processes or cpu_count(), len(filenames))
+    if processes > 1:
+        pool = Pool(processes)
+        parsed = pool.map(_parse_annotation, filenames, chunksize=max(1, len(filenames) // (processes * 4)))
+        pool.close()
+        pool.join()
     else:
-        with open(annocache, 'rb') as f:
-            recs = pickle.load(f)
+        parsed = [_parse_annotation(filename) for filename in filenames]
 
-    # extract objects in :param classname:
-    class_recs = {}
-    npos = 0
-    for image_filename in image_filenames:
-        objects = [obj for obj in recs[image_filename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in objects])
-        difficult = np.array([x['difficult'] for x in objects]).astype(np.bool)
-        det = [False] * len(objects)  # stand for detected
-        npos = npos + sum(~difficult)
-        class_recs[image_filename] = {'bbox': bbox,
-                                      'difficult': difficult,
-                                      'det': det}
-
-    # read detections
-    detfile = detpath.format(classname)
-    with open(detfile, 'r') as f:
-        lines = f.readlines()
+    # keep unchanged images, changed ones are appended with their new objects
+    changed_names = set(image_name for image_name, _ in changed)
+    keep_image = np.array([image_name not in changed_names for image_name in annotations['image_names']], dtype=bool)
+    new_index = np.cumsum(keep_image) - 1
+    keep_object = keep_image[annotations['image_index']]
+    class_names = list(annotations['class_names'])
+    class_index = {class_name: ind for ind, class_name in enumerate(class_names)}
+    object_num = [len(names) for names, _, _ in parsed]
+    object_names = [name for names, _, _ in parsed for name in names]
+    for name in object_names:
+        if name not in class_index:
+            class_index[name] = len(class_names)
+            class_names.append(name)
+    kept_num = int(keep_image.sum())
+
+    annotations = {
+        'image_names': [image_name for image_name, keep in zip(annotations['image_names'], keep_image) if keep] +
+                       [image_name for image_name, _ in changed],
+        'class_names': class_names,
+        'file_mtime': np.concatenate((annotations['file_mtime'][keep_image],
+                                      [stat.st_mtime for _, stat in changed])).astype(np.float64),
+        'file_size': np.concatenate((annotations['file_size'][keep_image],
+                                     [stat.st_size for _, stat in changed])).astype(np.int64),
+        'boxes': np.concatenate((annotations['boxes'][keep_object],
+                                 np.array([box for _, boxes, _ in parsed for box in boxes],
+                                          dtype=np.int32).reshape((-1, 4)))),
+        'image_index': np.concatenate((new_index[annotations['image_index'][keep_object]],
+                                       np.repeat(np.arange(len(parsed)) + kept_num, object_num))).astype(np.int32),
+        'class_code': np.concatenate((annotations['class_code'][keep_object],
+                                      [class_index[name] for name in object_names])).astype(np.int32),
+        'difficult': np.concatenate((annotations['difficult'][keep_object],
+                                     np.array([d for _, _, difficult in parsed for d in difficult],
+                                              dtype=bool))).astype(bool),
+    }
+    logger.info('saving annotations cache to %s' % annocache)
+    write_annotation_cache(annocache, annopath, annotations)
+    return annotations
+
+
+def get_class_recs(annotations, image_filenames, classnames):
+    """
+    extract objects of every class from the columnar annotations, ordered by image
+    :return: {classname: (class_recs, npos)}, class_recs as in voc_match, indexed by position in image_filenames
+    """
+    image_index = {image_name: ind for ind, image_name in enumerate(annotations['image_names'])}
+    image_positions = np.array([image_index[image_filename] for image_filename in image_filenames], dtype=np.int64)
+    # position in image_filenames of every cached image, a repeated image takes its last position
+    position_of_image = np.full(len(annotations['image_names']), -1, dtype=np.int64)
+    position_of_image[image_positions] = np.arange(len(image_filenames))
+    object_positions = position_of_image[annotations['image_index']]
+    class_index = {class_name: ind for ind, class_name in enumerate(annotations['class_names'])}
+
+    all_class_recs = {}
+    for classname in classnames:
+        in_class = (annotations['class_code'] == class_index.get(classname, -1)) & (object_positions >= 0)
+        order = np.argsort(object_positions[in_class], kind='stable')
+        positions = object_positions[in_class][order]
+        difficult = np.asarray(annotations['difficult'][in_class][order], dtype=bool)
+        class_recs = {'bbox': np.asarray(annotations['boxes'][in_class][order]),
+                      'difficult': difficult,
+                      'offsets': np.searchsorted(positions, np.arange(len(image_filenames) + 1), side='left')}
+        # a repeated image counts its objects again, as the per-image loop did
+        not_difficult = np.bincount(annotations['image_index'][in_class][~annotations['difficult'][in_class]],
+                                    minlength=len(annotations['image_names']))
+        npos = int(not_difficult[image_positions].sum())
+        all_class_recs[classname] = (class_recs, npos)
+    return all_class_recs
 
-    splitlines = [x.strip().split(' ') for x in lines]
-    image_ids = [x[0] for x in splitlines]
-    confidence = np.array([float(x[1]) for x in splitlines])
-    bbox = np.array([[float(z) for z in x[2:]] for x in splitlines])
+
+def read_detections(detfile, image_filenames):
+    """
+    read text or binary detection results
+    :return: image codes (index in image_filenames) and bbox sorted by descending confidence
+    """
+    image_names, image_codes, confidence, bbox = read_detection_file(detfile)
+    image_index = {image_filename: ind for ind, image_filename in enumerate(image_filenames)}
+    image_codes = np.array([image_index[x] for x in image_names], dtype=np.int64)[image_codes]
 
     # sort by confidence
     if bbox.shape[0] > 0:
         sorted_inds = np.argsort(-confidence)
-        sorted_scores = np.sort(-confidence)
         bbox = bbox[sorted_inds, :]
-        image_ids = [image_ids[x] for x in sorted_inds]
+        image_codes = image_codes[sorted_inds]
+    return image_codes, np.asarray(bbox)
+
+
+def eval_class(detfile, image_filenames, class_recs, npos, ovthresh=0.5, use_07_metric=False):
+    """
+    :return: rec, prec, ap of one class
+    """
+    image_codes, bbox = read_detections(detfile, image_filenames)
 
     # go down detections and mark true positives and false positives
-    nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        r = class_recs[image_ids[d]]
-        bb = bbox[d, :].astype(float)
-        ovmax = -np.inf
-        bbgt = r['bbox'].astype(float)
-
-        if bbgt.size > 0:
-            # compute overlaps
-            # intersection
-            ixmin = np.maximum(bbgt[:, 0], bb[0])
-            iymin = np.maximum(bbgt[:, 1], bb[1])
-            ixmax = np.minimum(bbgt[:, 2], bb[2])
-            iymax = np.minimum(bbgt[:, 3], bb[3])
-            # 此处不需加一(for_myself)
-            iw = np.maximum(ixmax - ixmin + 1., 0.)
-            ih = np.maximum(iymax - iymin + 1., 0.)
-            inters = iw * ih
-
-            # union
-            uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-                   (bbgt[:, 2] - bbgt[:, 0] + 1.) *
-                   (bbgt[:, 3] - bbgt[:, 1] + 1.) - inters)
-
-            overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
-
-        if ovmax > ovthresh:
-            if not r['difficult'][jmax]:
-                if not r['det'][jmax]:
-                    tp[d] = 1.
-                    r['det'][jmax] = 1
-                else:
-                    fp[d] = 1.
-        else:
-            fp[d] = 1.
+    tp, fp = voc_match(image_codes, bbox, class_recs, ovthresh)
 
     # compute precision recall
     fp = np.cumsum(fp)
@@ -176,3 +351,164 @@ def voc_eval(detpath, annopath, imageset_file, classname, annocache, ovthresh=0.
     ap = voc_ap(rec, prec, use_07_metric)
 
     return rec, prec, ap
+
+
+def voc_eval(detpath, annopath, imageset_file, classname, annocache, ovthresh=0.5, use_07_metric=False):
+    """
+    pascal voc evaluation
+    :param detpath: detection results detpath.format(classname)
+    :param annopath: annotations annopath.format(classname)
+    :param imageset_file: text file containing list of images
+    :param classname: category name
+    :param annocache: caching annotations, re-parses only xml whose mtime or size changed
+    :param ovthresh: overlap threshold
+    :param use_07_metric: whether to use voc07's 11 point ap computation
+    :return: rec, prec, ap
+    """
+    image_filenames = load_image_set(imageset_file)
+    # load annotations from cache
+    annotations = load_annotations(annopath, image_filenames, annocache)
+    # extract objects in :param classname:
+    class_recs, npos = get_class_recs(annotations, image_filenames, [classname])[classname]
+    return eval_class(detpath.format(classname), image_filenames, class_recs, npos, ovthresh, use_07_metric)
+
+
+def _eval_class_task(task):
+    classname, detfile, image_filenames, class_recs, npos, ovthresh, use_07_metric = task
+    return classname, eval_class(detfile, image_filenames, class_recs, npos, ovthresh, use_07_metric)
+
+
+def _map_classes(func, tasks, processes=0):
+    processes = min(processes or cpu_count(), len(tasks))
+    if processes > 1:
+        pool = Pool(processes)
+        class_results = pool.map(func, tasks)
+        pool.close()
+        pool.join()
+    else:
+        class_results = [func(task) for task in tasks]
+    return class_results
+
+
+def voc_eval_all(detpath, annopath, imageset_file, classnames, annocache, ovthresh=0.5, use_07_metric=False,
+                 processes=0):
+    """
+    pascal voc evaluation of all classes, imageset and annotations are loaded only once
+    :param classnames: category names
+    :param processes: size of the process pools parsing xml and evaluating classes, 0 for cpu_count()
+    other params are the same as voc_eval
+    :return: {classname: (rec, prec, ap)}, mAP
+    """
+    classnames = list(classnames)
+    image_filenames = load_image_set(imageset_file)
+    annotations = load_annotations(annopath, image_filenames, annocache, processes)
+    all_class_recs = get_class_recs(annotations, image_filenames, classnames)
+    tasks = [(classname, detpath.format(classname), image_filenames) + all_class_recs[classname] +
+             (ovthresh, use_07_metric) for classname in classnames]
+
+    results = dict(_map_classes(_eval_class_task, tasks, processes))
+    mean_ap = float(np.mean([results[classname][2] for classname in classnames])) if classnames else 0.
+    for classname in classnames:
+        logger.info('AP for %s = %.4f' % (classname, results[classname][2]))
+    logger.info('mAP = %.4f' % mean_ap)
+    return results, mean_ap
+
+
+def box_area(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    return (boxes[:, 2] - boxes[:, 0] + 1.) * (boxes[:, 3] - boxes[:, 1] + 1.)
+
+
+def eval_class_coco(detfile, image_filenames, class_recs, ovthresholds=COCO_OVTHRESHOLDS,
+                    area_ranges=COCO_AREA_RANGES, method=101):
+    """
+    AP of one class at every overlap threshold and area range, the IoU matrices are computed once
+    ground truth outside an area range is ignored like difficult, so are unmatched detections outside it
+    :return: ap [len(area_ranges), len(ovthresholds)], nan for a range without ground truth
+    """
+    image_codes, bbox = read_detections(detfile, image_filenames)
+    ovmax, gtmax = max_overlaps(image_codes, bbox, class_recs)
+    gt_area = box_area(class_recs['bbox'])
+    det_area = box_area(bbox)
+    difficult = class_recs['difficult']
+
+    rec_list, prec_list, npos_list = [], [], []
+    for _, min_area, max_area in area_ranges:
+        gt_outside = (gt_area < min_area) | (gt_area >= max_area)
+        det_outside = (det_area < min_area) | (det_area >= max_area)
+        tp, fp = greedy_assign(ovmax, gtmax, difficult | gt_outside, ovthresholds, det_outside)
+        npos = int(np.sum(~difficult & ~gt_outside))
+        fp = np.cumsum(fp, axis=1)
+        tp = np.cumsum(tp, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rec = tp / float(npos)
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        rec_list.extend(rec)
+        prec_list.extend(prec)
+        npos_list.append(npos)
+    ap = batch_average_precision(rec_list, prec_list, method).reshape((len(area_ranges), len(ovthresholds)))
+    ap[np.array(npos_list) == 0] = np.nan
+    return ap
+
+
+def summarize_coco(ap, ovthresholds=COCO_OVTHRESHOLDS, area_ranges=COCO_AREA_RANGES):
+    """
+    :param ap: [len(area_ranges), len(ovthresholds)]
+    :return: {'AP': AP@[.5:.95], 'AP50', 'AP75', 'AP_small', 'AP_medium', 'AP_large'}
+    """
+    ovthresholds = np.asarray(ovthresholds)
+    area_names = [name for name, _, _ in area_ranges]
+    summary = {}
+    with np.errstate(invalid='ignore'):
+        all_ap = ap[area_names.index('all')]
+        summary['AP'] = float(np.mean(all_ap))
+        for ovthresh, key in ((.5, 'AP50'), (.75, 'AP75')):
+            inds = np.flatnonzero(np.isclose(ovthresholds, ovthresh))
+            if len(inds):
+                summary[key] = float(all_ap[inds[0]])
+        for name in area_names:
+            if name != 'all':
+                summary['AP_' + name] = float(np.mean(ap[area_names.index(name)]))
+    return summary
+
+
+def _eval_class_coco_task(task):
+    classname, detfile, image_filenames, class_recs, ovthresholds, area_ranges, method = task
+    return classname, eval_class_coco(detfile, image_filenames, class_recs, ovthresholds, area_ranges, method)
+
+
+def voc_eval_coco(detpath, annopath, imageset_file, classnames, annocache, ovthresholds=COCO_OVTHRESHOLDS,
+                  area_ranges=COCO_AREA_RANGES, method=101, processes=0):
+    """
+    coco-style evaluation of all classes: AP@[.5:.95], AP50, AP75 and AP by ground truth area in one pass
+    the IoU matrix of every image is computed once and matched greedily for all thresholds, with the voc_eval
+    matching rule (overlap > threshold, the max-overlap ground truth of each detection)
+    :param ovthresholds: overlap thresholds, .50:.05:.95 by default
+    :param area_ranges: ((name, min_area, max_area), ...), must include 'all'; areas follow the +1 pixel convention
+    :param method: average_precision method, 101-point interpolation by default
+    other params are the same as voc_eval_all
+    :return: {classname: summary}, mean summary over classes; summary as in summarize_coco plus 'ap' matrix
+    """
+    classnames = list(classnames)
+    image_filenames = load_image_set(imageset_file)
+    annotations = load_annotations(annopath, image_filenames, annocache, processes)
+    all_class_recs = get_class_recs(annotations, image_filenames, classnames)
+    tasks = [(classname, detpath.format(classname), image_filenames, all_class_recs[classname][0], ovthresholds,
+              area_ranges, method) for classname in classnames]
+
+    results = {}
+    for classname, ap in _map_classes(_eval_class_coco_task, tasks, processes):
+        results[classname] = summarize_coco(ap, ovthresholds, area_ranges)
+        results[classname]['ap'] = ap
+    # classes without ground truth in a range are left out of its mean
+    mean_summary = {}
+    if classnames:
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean_ap = np.nanmean([results[classname]['ap'] for classname in classnames], axis=0)
+        mean_summary = summarize_coco(mean_ap, ovthresholds, area_ranges)
+    for classname in classnames:
+        logger.info('%s: %s' % (classname, ', '.join('%s = %.4f' % (key, value) for key, value in
+                                                     sorted(results[classname].items()) if key != 'ap')))
+    logger.info('mean: %s' % ', '.join('%s = %.4f' % (key, value) for key, value in sorted(mean_summary.items())))
+    return results, mean_summary
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+按slide重采样的bootstrap置信区间
+
+每张slide在各阈值下的TP1/TP2/FP/FN构成 slide x 阈值 的计数矩阵,
+一次有放回地抽取slide等价于给每张slide一个出现次数权重, 所有重采样的计数即为
+权重矩阵(resamples x slide)与计数矩阵的乘积, 不需要重新扫描。
+"""
+import numpy as np
+
+OFFSET = 1e-8
+
+DEFAULT_BOOTSTRAP = {
+    'resamples': 0,
+    'alpha': 0.05,
+    'seed': 0,
+    'max_points': 500,
+}
+
+
+def get_bootstrap_config(bootstrap):
+    bootstrap_config = dict(DEFAULT_BOOTSTRAP)
+    bootstrap_config.update(bootstrap or {})
+    return bootstrap_config
+
+
+def resample_weights(slide_num, resamples, seed):
+    """
+    :return: (resamples, slide_num), 每次重采样中每张slide被抽中的次数
+    """
+    rng = np.random.RandomState(seed)
+    return rng.multinomial(slide_num, np.full(slide_num, 1. / slide_num), size=resamples).astype(np.float64)
+
+
+def bootstrap_interval(TP1, TP2, FP, FN, resamples, alpha=0.05, seed=0):
+    """
+    :param TP1, TP2, FP, FN: (slide_num, T) 每张slide在各阈值下的计数
+    :return: {'precision_ci_lower': (T,), 'precision_ci_upper': (T,), recall/F1同理}
+    """
+    slide_counts = np.stack((TP1, TP2, FP, FN), axis=1).astype(np.float64)
+    slide_num, _, threshold_num = slide_counts.shape
+    weights = resample_weights(slide_num, resamples, seed)
+    # (resamples, slide_num) x (slide_num, 4 * T)
+    counts = weights.dot(slide_counts.reshape((slide_num, -1))).reshape((resamples, 4, threshold_num))
+    TP1, TP2, FP, FN = counts[:, 0], counts[:, 1], counts[:, 2], counts[:, 3]
+    precision = TP1 / (TP1 + FP + OFFSET)
+    recall = TP2 / (TP2 + FN + OFFSET)
+    F1 = 2 * precision * recall / (precision + recall + OFFSET)
+
+    interval = {}
+    for name, values in (('precision', precision), ('recall', recall), ('F1', F1)):
+        lower, upper = np.percentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        interval[name + '_ci_lower'] = lower
+        interval[name + '_ci_upper'] = upper
+    return interval
+
+
+def add_bootstrap_interval(result_dict, slide_counts_func, bootstrap=None):
+    """
+    在result_dict中加入ci_confidence_list以及precision/recall/F1的上下界
+    :param slide_counts_func: 输入阈值数组, 返回每张slide的TP1, TP2, FP, FN, 形状均为(slide_num, T)
+    """
+    bootstrap_config = get_bootstrap_config(bootstrap)
+    if bootstrap_config['resamples'] <= 0 or len(result_dict['confidence_list']) == 0:
+        return result_dict
+    # 阈值过多时只在按排名等间隔取的max_points个置信度上计算区间
+    confidence_list = np.unique(result_dict['confidence_list'])
+    if len(confidence_list) > bootstrap_config['max_points']:
+        index = np.round(np.linspace(0, len(confidence_list) - 1, bootstrap_config['max_points'])).astype(np.int64)
+        confidence_list = confidence_list[np.unique(index)]
+    TP1, TP2, FP, FN = slide_counts_func(confidence_list)
+    result_dict['ci_confidence_list'] = confidence_list
+    result_dict.update(bootstrap_interval(TP1, TP2, FP, FN, bootstrap_config['resamples'],
+                                          bootstrap_config['alpha'], bootstrap_config['seed']))
+    return result_dict
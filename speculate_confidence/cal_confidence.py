@@ -14,6 +14,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 
+from confidence_sweep import LabelOverlap
+
 OFFSET = 1e-8
 
 
@@ -49,19 +51,8 @@ def get_all_xml_regions_of_target_label(xml_file_directory, target_label):
     return dict
 
 
-def calc_pre_recall_F1_by_fixed_conf(confidence, all_pkl_result_dict, pkl_file_list, doctor_regions_dict,
-                                     target_label):
-    Total_TP1, Total_TP2, Total_FP, Total_FN = 0, 0, 0, 0
-    for file in pkl_file_list:
-        file_name = file.split('.')[0]
-        doctor_region_list = doctor_regions_dict[file_name]
-        result = all_pkl_result_dict[file]
-        computer_region_list = result[target_label]
-        TP1, TP2, FP, FN = handle_result(computer_region_list, doctor_region_list, confidence)
-        Total_TP1 += TP1
-        Total_TP2 += TP2
-        Total_FP += FP
-        Total_FN += FN
+def calc_pre_recall_F1_by_fixed_conf(confidence, label_overlap):
+    Total_TP1, Total_TP2, Total_FP, Total_FN = label_overlap.counts(confidence)
     precision = calc_precision(Total_TP1, Total_FP)
     recall = calc_recall(Total_TP2, Total_FN)
     F1 = calc_F1(precision, recall)
@@ -70,10 +61,11 @@ def calc_pre_recall_F1_by_fixed_conf(confidence, all_pkl_result_dict, pkl_file_l
 
 def get_precisions_recalls_F1s_by_confidences(sorted_confidence_list, all_pkl_result_dict, pkl_file_list,
                                               doctor_regions_dict, target_label):
-    _calc_pre_recall_F1_by_fixed_conf = partial(calc_pre_recall_F1_by_fixed_conf,
-                                                all_pkl_result_dict=all_pkl_result_dict,
-                                                pkl_file_list=pkl_file_list,
-                                                doctor_regions_dict=doctor_regions_dict, target_label=target_label)
+    # 相交矩阵只在这里计算一次, 每个阈值只做切片查询
+    start = time.time()
+    label_overlap = LabelOverlap.from_results(all_pkl_result_dict, pkl_file_list, doctor_regions_dict, target_label)
+    print("cost time for overlap cache: {:f}s".format(time.time() - start))
+    _calc_pre_recall_F1_by_fixed_conf = partial(calc_pre_recall_F1_by_fixed_conf, label_overlap=label_overlap)
     # pool = Pool(cpu_count())
     # precision_recall_F1_list = pool.map(_calc_pre_recall_F1_by_fixed_conf, sorted_confidence_list)
     # pool.close()
@@ -194,52 +186,6 @@ def get_pickle_file_list(pickle_directory):
     return pickle_file_list
 
 
-def get_coincide_region_num(current_region_list, doctor_region_list):
-    if len(doctor_region_list) == 0 and len(current_region_list) != 0:
-        TP1, TP2, FN = 0, 0, 0
-        FP = len(current_region_list) - 0
-        return TP1, TP2, FP, FN
-    if (len(doctor_region_list), len(current_region_list)) == (0, 0):
-        return 0, 0, 0, 0
-    if len(doctor_region_list) != 0 and len(current_region_list) == 0:
-        TP1, TP2, FP = 0, 0, 0
-        FN = len(doctor_region_list)
-        return TP1, TP2, FP, FN
-
-    gt_bbox = np.array(doctor_region_list)
-    mc_bbox = np.array(current_region_list).reshape((-1, 1, 5))[:, :, :4]
-    xmin = np.maximum(gt_bbox[:, 0], mc_bbox[:, :, 0])
-    ymin = np.maximum(gt_bbox[:, 1], mc_bbox[:, :, 1])
-    xmax = np.minimum(gt_bbox[:, 2], mc_bbox[:, :, 2])
-    ymax = np.minimum(gt_bbox[:, 3], mc_bbox[:, :, 3])
-    w = np.maximum(xmax - xmin, 0.)
-    h = np.maximum(ymax - ymin, 0.)
-    inter = w * h
-    inter_check = np.where(inter > 0, 1, 0)
-    tp_array_1 = np.sum(inter_check, axis=1)
-    tp_array_1 = np.where(tp_array_1 > 0, 1, 0)
-    TP1 = np.sum(tp_array_1)
-
-    TP2 = np.sum(inter_check, axis=0)
-    TP2 = np.where(TP2 > 0, 1, 0)
-    TP2 = np.sum(TP2)
-    FP = len(current_region_list) - TP1
-    FN = len(doctor_region_list) - TP2
-    return TP1, TP2, FP, FN
-
-
-def handle_result(computer_region_list, doctor_region_list, init_confidence):
-    # 根据置信度排序
-    sorted_all_regions = sorted(computer_region_list, key=lambda x: x[-1])
-    current_region_list = []
-    for index, region in enumerate(sorted_all_regions):
-        if region[-1] >= init_confidence:
-            current_region_list = sorted_all_regions[index:]
-            break
-    TP1, TP2, FP, FN = get_coincide_region_num(current_region_list, doctor_region_list)
-    return TP1, TP2, FP, FN
-
-
 def calc_precision(TP, FP):
     return float('%.4f' % (TP / (TP + FP + OFFSET)))
 
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+一次排序加累计计数得到整条precision/recall/F1曲线
+
+每个(slide, label)只计算一次检测框与医生框的相交, 保存为SlideOverlap:
+检测框按置信度降序排列, 每个检测框记录是否与任一医生框相交(成为TP1的最低置信度即自身置信度),
+每个医生框记录覆盖它的最高置信度(成为TP2的最低置信度)。
+任意阈值下的TP1/TP2/FP/FN只需切片或searchsorted, 不需要重新排序和计算相交。
+相交由box_overlap.overlap_pairs按x方向扫描得到, 只保存相交的(检测框, 医生框)下标对及其IoU。
+
+匹配规则match_rule:
+    {'iou': 0., 'one_to_one': False}  默认, 任意相交即命中, 与原实现一致
+    iou > 0 时只有IoU >= iou的框对算命中; one_to_one为True时按置信度从高到低一对一贪心匹配
+同一张slide的不同匹配规则共用一次相交与IoU计算(SlideOverlap.with_rule)。
+"""
+import copy
+import os
+import sys
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from box_overlap import greedy_match, overlap_pairs_iou
+from detection_store import DetectionStore
+
+NEVER_HIT = -np.inf
+
+DEFAULT_MATCH_RULE = {
+    'iou': 0.,
+    'one_to_one': False,
+}
+
+
+def get_match_rule(match_rule):
+    rule = dict(DEFAULT_MATCH_RULE)
+    rule.update(match_rule or {})
+    return rule
+
+
+def get_match_rule_name(match_rule):
+    """
+    :return: 默认规则为'', 其它如 'iou0.5', 'iou0.5_1to1'
+    """
+    rule = get_match_rule(match_rule)
+    if rule == DEFAULT_MATCH_RULE:
+        return ''
+    return 'iou{:g}'.format(rule['iou']) + ('_1to1' if rule['one_to_one'] else '')
+
+
+def count_at_least(sorted_scores, confidences):
+    """
+    sorted_scores中 >= confidence 的个数
+    :param sorted_scores: 升序排列的分数
+    :param confidences: 阈值或阈值数组
+    :return: 与confidences形状相同的计数
+    """
+    return len(sorted_scores) - np.searchsorted(sorted_scores, confidences, side='left')
+
+
+def get_doctor_regions(doctor_regions_dict, file):
+    file_name = file.split('.')[0]
+    try:
+        return doctor_regions_dict[file_name]
+    except KeyError:
+        msg = 'No {} doctor xml'.format(file_name)
+        raise Exception(msg)
+
+
+class SlideOverlap:
+    """
+    单张slide单个label的相交缓存
+    """
+
+    def __init__(self, computer_region_list, doctor_region_list, match_rule=None):
+        mc_bbox = np.array(computer_region_list, dtype=np.float64).reshape((-1, 5))
+        gt_bbox = np.array(doctor_region_list, dtype=np.float64).reshape((-1, 4))
+        # 按置信度降序, 阈值对应的保留框即为前缀
+        order = np.argsort(-mc_bbox[:, 4], kind='stable')
+        self.boxes = mc_bbox[order, :4]
+        self.scores = mc_bbox[order, 4]
+        self.doctor_boxes = gt_bbox
+        # 所有相交的(检测框, 医生框)下标对及IoU, 检测框下标对应降序排列后的位置
+        self.all_pair_det_index, self.all_pair_gt_index, self.all_pair_iou = overlap_pairs_iou(self.boxes, gt_bbox)
+        self._apply_rule(match_rule)
+
+    def _apply_rule(self, match_rule):
+        rule = get_match_rule(match_rule)
+        self.match_rule = rule
+        # 按匹配规则命中的框对
+        det_index, gt_index, iou = self.all_pair_det_index, self.all_pair_gt_index, self.all_pair_iou
+        if rule['iou'] > 0:
+            keep = iou >= rule['iou']
+            det_index, gt_index, iou = det_index[keep], gt_index[keep], iou[keep]
+        if rule['one_to_one']:
+            # 检测框已按置信度降序, 任一阈值下保留框的匹配结果与只匹配这些框时相同
+            det_index, gt_index = greedy_match(det_index, gt_index, iou)
+        self.pair_det_index, self.pair_gt_index = det_index, gt_index
+
+        self.det_hit = np.zeros(len(self.scores), dtype=bool)
+        self.det_hit[self.pair_det_index] = True
+        self.det_hit_cumsum = np.cumsum(self.det_hit)
+        # 每个医生框被覆盖时的最高置信度, 未被任何检测框覆盖的记为NEVER_HIT
+        self.gt_best_scores = np.full(len(self.doctor_boxes), NEVER_HIT)
+        np.maximum.at(self.gt_best_scores, self.pair_gt_index, self.scores[self.pair_det_index])
+        self.sorted_gt_best_scores = np.sort(self.gt_best_scores)
+
+    def with_rule(self, match_rule):
+        """
+        同一组框在另一匹配规则下的SlideOverlap, 框与IoU不重新计算
+        """
+        slide_overlap = copy.copy(self)
+        slide_overlap._apply_rule(match_rule)
+        return slide_overlap
+
+    @property
+    def overlap(self):
+        """
+        布尔相交矩阵(检测框 x 医生框), 按需生成
+        """
+        overlap = np.zeros((len(self.scores), len(self.doctor_boxes)), dtype=bool)
+        overlap[self.pair_det_index, self.pair_gt_index] = True
+        return overlap
+
+    @property
+    def gt_num(self):
+        return len(self.doctor_boxes)
+
+    def kept_num(self, confidence):
+        """
+        置信度 >= confidence 的检测框个数, 即保留框在scores中的前缀长度
+        """
+        return np.searchsorted(-self.scores, -np.asarray(confidence, dtype=np.float64), side='right')
+
+    def kept_overlap(self, confidence):
+        kept = self.kept_num(confidence)
+        overlap = np.zeros((kept, len(self.doctor_boxes)), dtype=bool)
+        in_kept = self.pair_det_index < kept
+        overlap[self.pair_det_index[in_kept], self.pair_gt_index[in_kept]] = True
+        return overlap
+
+    def counts(self, confidence):
+        """
+        :param confidence: 阈值或阈值数组
+        :return: TP1, TP2, FP, FN
+        """
+        kept = self.kept_num(confidence)
+        TP1 = np.concatenate(([0], self.det_hit_cumsum))[kept]
+        TP2 = count_at_least(self.sorted_gt_best_scores, confidence)
+        FP = kept - TP1
+        FN = self.gt_num - TP2
+        return TP1, TP2, FP, FN
+
+
+class LabelOverlap:
+    """
+    单个label在所有slide上的相交缓存, 供曲线扫描、AP计算以及任意阈值查询共用
+    """
+
+    def __init__(self, label, slide_overlap_dict):
+        self.label = label
+        self.slides = slide_overlap_dict
+        slide_list = list(slide_overlap_dict.values())
+        self.det_scores = np.sort(self._concat([i.scores for i in slide_list]))
+        self.tp1_scores = np.sort(self._concat([i.scores[i.det_hit] for i in slide_list]))
+        self.tp2_scores = np.sort(self._concat([i.gt_best_scores for i in slide_list]))
+
+    @staticmethod
+    def _concat(array_list):
+        return np.concatenate(array_list) if array_list else np.zeros(0)
+
+    @classmethod
+    def from_results(cls, all_pkl_result_dict, pkl_file_list, doctor_regions_dict, target_label):
+        slide_overlap_dict = {}
+        for file in pkl_file_list:
+            doctor_region_list = get_doctor_regions(doctor_regions_dict, file)
+            computer_region_list = all_pkl_result_dict[file][target_label]
+            slide_overlap_dict[file] = SlideOverlap(computer_region_list, doctor_region_list)
+        return cls(target_label, slide_overlap_dict)
+
+    def with_rule(self, match_rule):
+        """
+        :return: 另一匹配规则下的LabelOverlap, 各slide共用已计算的相交与IoU
+        """
+        return LabelOverlap(self.label, {file: slide_overlap.with_rule(match_rule)
+                                         for file, slide_overlap in self.slides.items()})
+
+    @property
+    def gt_num(self):
+        return len(self.tp2_scores)
+
+    def counts(self, confidence):
+        """
+        :param confidence: 阈值或阈值数组
+        :return: TP1, TP2, FP, FN
+        """
+        kept = count_at_least(self.det_scores, confidence)
+        TP1 = count_at_least(self.tp1_scores, confidence)
+        TP2 = count_at_least(self.tp2_scores, confidence)
+        FP = kept - TP1
+        FN = self.gt_num - TP2
+        return TP1, TP2, FP, FN
+
+    def slide_counts(self, confidences):
+        """
+        每张slide分别计数, 供按slide重采样使用
+        :param confidences: 阈值数组
+        :return: TP1, TP2, FP, FN, 形状均为(slide数, 阈值数)
+        """
+        confidences = np.asarray(confidences, dtype=np.float64)
+        counts = np.zeros((4, len(self.slides), len(confidences)), dtype=np.int64)
+        for row, slide_overlap in enumerate(self.slides.values()):
+            counts[:, row] = slide_overlap.counts(confidences)
+        return counts[0], counts[1], counts[2], counts[3]
+
+
+def sweep_counts(confidences, label_overlap):
+    """
+    一次性得到所有阈值下的TP1, TP2, FP, FN
+    :param confidences: 阈值数组
+    :param label_overlap: LabelOverlap
+    :return: TP1, TP2, FP, FN 四个数组
+    """
+    return label_overlap.counts(np.asarray(confidences, dtype=np.float64))
+
+
+# 工作进程中打开的DetectionStore.results(), 见_init_store_worker
+_worker_results = None
+
+
+def _init_store_worker(store_path):
+    # 每个工作进程自己memmap打开同一文件, 检测框不经过pickle传递, 各进程共享page cache
+    global _worker_results
+    _worker_results = DetectionStore(store_path).results()
+
+
+def _slide_label_overlaps(task):
+    file, result, label_regions = task
+    if result is None:
+        result = _worker_results[file]
+    return {label: SlideOverlap(result[label], doctor_region_list)
+            for label, doctor_region_list in label_regions.items()}
+
+
+def build_label_overlaps(slide_catalog, xml_region_index, labels, processes=0):
+    """
+    每张slide只访问一次, 同时计算所有label的SlideOverlap, 按slide分配到多个进程
+    :param slide_catalog: SlideCatalog
+    :param xml_region_index: XmlRegionIndex
+    :param labels: 需要计算的label
+    :param processes: 进程数, 0为cpu_count()
+    :return: {label: LabelOverlap}
+    """
+    labels = list(labels)
+    processes = processes or cpu_count()
+    use_pool = processes > 1 and len(slide_catalog) > 1
+    # 来自DetectionStore时由工作进程自己读取检测框, 任务中只有slide名
+    store_path = slide_catalog.store_path if use_pool else None
+    tasks = []
+    for file in slide_catalog.pkl_file_list:
+        doctor_label_regions = get_doctor_regions(xml_region_index.regions, file)
+        label_regions = {label: doctor_label_regions.get(label, np.zeros((0, 4))) for label in labels}
+        if store_path:
+            tasks.append((file, None, label_regions))
+        else:
+            result = slide_catalog.results[file]
+            tasks.append((file, {label: result[label] for label in labels}, label_regions))
+
+    if use_pool:
+        pool = Pool(processes, _init_store_worker, (store_path,)) if store_path else Pool(processes)
+        slide_overlap_list = pool.map(_slide_label_overlaps, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+        pool.close()
+        pool.join()
+    else:
+        slide_overlap_list = [_slide_label_overlaps(task) for task in tasks]
+
+    label_overlap_dict = {}
+    for label in labels:
+        slide_overlap_dict = {}
+        for task, slide_overlaps in zip(tasks, slide_overlap_list):
+            slide_overlap_dict[task[0]] = slide_overlaps[label]
+        label_overlap_dict[label] = LabelOverlap(label, slide_overlap_dict)
+    return label_overlap_dict
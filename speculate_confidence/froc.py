@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+FROC曲线: 横轴为平均每张slide的FP个数, 纵轴为sensitivity(被检出的医生框比例)
+
+与precision/recall使用同一次扫描得到的计数: FP_per_slide = FP / slide数, sensitivity = TP2 / 医生框数。
+某个FP率下的sensitivity取平均FP不超过该值的阈值中最大的sensitivity,
+froc_score为在fp_rates上的sensitivity均值。
+"""
+import numpy as np
+
+DEFAULT_FROC = {
+    'fp_rates': [0.125, 0.25, 0.5, 1, 2, 4, 8],
+}
+
+
+def get_froc_config(froc):
+    froc_config = dict(DEFAULT_FROC)
+    froc_config.update(froc or {})
+    return froc_config
+
+
+def sensitivity_at_fp_rates(fp_per_slide, sensitivity, fp_rates):
+    """
+    :return: 每个FP率下能达到的最大sensitivity, 没有阈值满足时为0
+    """
+    fp_per_slide = np.asarray(fp_per_slide, dtype=np.float64)
+    sensitivity = np.asarray(sensitivity, dtype=np.float64)
+    if len(fp_per_slide) == 0:
+        return np.zeros(len(fp_rates))
+    order = np.argsort(fp_per_slide, kind='stable')
+    best_sensitivity = np.maximum.accumulate(sensitivity[order])
+    index = np.searchsorted(fp_per_slide[order], fp_rates, side='right') - 1
+    return np.where(index >= 0, best_sensitivity[np.maximum(index, 0)], 0.)
+
+
+def add_froc_curve(result_dict, TP2_list, FP_list, gt_num, slide_num, froc=None):
+    """
+    在result_dict中加入fp_per_slide_list, sensitivity_list, froc_fp_rates, froc_sensitivities, froc_score
+    """
+    froc_config = get_froc_config(froc)
+    fp_rates = np.asarray(froc_config['fp_rates'], dtype=np.float64)
+    fp_per_slide = np.asarray(FP_list, dtype=np.float64) / max(slide_num, 1)
+    sensitivity = np.asarray(TP2_list, dtype=np.float64) / max(gt_num, 1)
+    froc_sensitivities = sensitivity_at_fp_rates(fp_per_slide, sensitivity, fp_rates)
+    result_dict['fp_per_slide_list'] = fp_per_slide
+    result_dict['sensitivity_list'] = sensitivity
+    result_dict['froc_fp_rates'] = fp_rates
+    result_dict['froc_sensitivities'] = froc_sensitivities
+    result_dict['froc_score'] = float(np.mean(froc_sensitivities)) if len(fp_rates) else 0.
+    return result_dict
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+按条件直接求阈值(工作点), 不需要扫描整条曲线
+
+每个查询是一个字典:
+    {'label': 'hsil', 'precision': 0.8}                  precision >= 0.8 的最低置信度(recall最大)
+    {'label': 'hsil', 'recall': 0.9}                     recall >= 0.9 的最高置信度(precision最大)
+    {'label': 'hsil', 'precision': 0.8, 'recall': 0.5}   同时满足两个条件的区间内F1最大的置信度
+    {'label': 'hsil'}                                    F1最大的置信度
+    objective可指定为 'recall'(区间内最低置信度) / 'precision'(区间内最高置信度) / 'F1'
+
+候选阈值为实际出现过的置信度(相邻置信度之间计数不变)。recall随阈值单调不增, 用二分查找确定recall条件的阈值上界,
+每次取值只做一次searchsorted计数, 共计算O(log n)个阈值; precision不单调, 用向量化计数一次得到所有阈值下的precision,
+取满足条件的阈值, 结果是精确的; F1最大值同样用向量化计数比较所有满足条件的阈值。
+"""
+import numpy as np
+
+OFFSET = 1e-8
+
+
+def _metrics(TP1, TP2, FP, FN):
+    precision = TP1 / (TP1 + FP + OFFSET)
+    recall = TP2 / (TP2 + FN + OFFSET)
+    F1 = 2 * precision * recall / (precision + recall + OFFSET)
+    return precision, recall, F1
+
+
+class OperatingPointSolver:
+    """
+    :param candidates: 升序的候选阈值
+    :param counts_func: 输入阈值或阈值数组, 返回TP1, TP2, FP, FN
+    """
+
+    def __init__(self, candidates, counts_func):
+        self.candidates = np.asarray(candidates, dtype=np.float64)
+        self.counts_func = counts_func
+        self.evaluated_num = 0
+
+    @classmethod
+    def from_label_overlap(cls, label_overlap, confidence_offset=0.):
+        scores = label_overlap.det_scores
+        return cls(np.unique(scores[scores >= confidence_offset]), label_overlap.counts)
+
+    @classmethod
+    def from_counts(cls, confidence_list, TP1_list, TP2_list, FP_list, FN_list):
+        """
+        由已有阈值轴上的计数构造, 如增量模式的直方图
+        """
+        confidence_list = np.asarray(confidence_list, dtype=np.float64)
+        counts = np.array([TP1_list, TP2_list, FP_list, FN_list], dtype=np.int64)
+
+        def counts_func(confidence):
+            index = np.searchsorted(confidence_list, confidence, side='left')
+            return tuple(counts[:, index])
+        return cls(confidence_list, counts_func)
+
+    def metrics(self, index):
+        self.evaluated_num += np.size(index)
+        return _metrics(*self.counts_func(self.candidates[index]))
+
+    def _first_true(self, lo, hi, predicate):
+        # [lo, hi)中第一个predicate为True的下标, 要求predicate单调(False...True)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if predicate(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _precision_satisfied(self, min_precision):
+        # precision不单调, 向量化计数一次得到所有候选阈值是否满足条件
+        return self.metrics(np.arange(len(self.candidates)))[0] >= min_precision
+
+    def feasible_indices(self, min_precision=None, min_recall=None):
+        """
+        :return: 满足条件的候选阈值下标(升序), 只有recall条件时为区间[lo, hi)
+        """
+        lo, hi = 0, len(self.candidates)
+        satisfied = None
+        if min_precision is not None:
+            satisfied = self._precision_satisfied(min_precision)
+            lo = int(np.argmax(satisfied)) if satisfied.any() else hi
+        if min_recall is not None:
+            hi = self._first_true(lo, hi, lambda i: self.metrics(i)[1] < min_recall)
+        if satisfied is None:
+            return lo, hi
+        index = np.arange(lo, max(lo, hi))
+        return index[satisfied[index]]
+
+    def solve(self, min_precision=None, min_recall=None, objective=None):
+        """
+        :return: 阈值下标, 无解时为None
+        """
+        if objective is None:
+            if min_precision is not None and min_recall is None:
+                objective = 'recall'
+            elif min_recall is not None and min_precision is None:
+                objective = 'precision'
+            else:
+                objective = 'F1'
+        if objective not in ('precision', 'recall', 'F1'):
+            raise Exception('Unknown operating point objective {}'.format(objective))
+
+        feasible = self.feasible_indices(min_precision, min_recall)
+        if min_precision is None:
+            # recall单调, 满足条件的是一个区间
+            lo, hi = feasible
+            if lo >= hi:
+                return None
+            if objective == 'recall':
+                return lo
+            if objective == 'precision':
+                return hi - 1
+            feasible = np.arange(lo, hi)
+        if len(feasible) == 0:
+            return None
+        if objective == 'recall':
+            return int(feasible[0])
+        if objective == 'precision':
+            return int(feasible[-1])
+        F1 = self.metrics(feasible)[2]
+        return int(feasible[np.argmax(F1)])
+
+
+def solve_operating_points(solver_dict, queries):
+    """
+    :param solver_dict: {label: OperatingPointSolver}
+    :param queries: 查询字典的列表, 见模块说明
+    :return: 与queries等长的结果字典列表, 无解时confidence为None
+    """
+    answer_list = []
+    for query in queries:
+        label = query['label']
+        if label not in solver_dict:
+            raise Exception('No {} label for operating point'.format(label))
+        solver = solver_dict[label]
+        index = solver.solve(query.get('precision'), query.get('recall'), query.get('objective'))
+        answer = dict(query)
+        answer['confidence'] = None
+        if index is not None:
+            TP1, TP2, FP, FN = solver.counts_func(solver.candidates[index])
+            precision, recall, F1 = _metrics(TP1, TP2, FP, FN)
+            answer.update({'confidence': float(solver.candidates[index]), 'precision_value': float(precision),
+                           'recall_value': float(recall), 'F1_value': float(F1), 'TP1': int(TP1), 'TP2': int(TP2),
+                           'FP': int(FP), 'FN': int(FN)})
+        answer_list.append(answer)
+    return answer_list
+
+
+def format_operating_point(answer):
+    constraint = ', '.join('{} >= {}'.format(k, answer[k]) for k in ('precision', 'recall') if k in answer)
+    head = '{} [{}]'.format(answer['label'], constraint or 'max F1')
+    if answer['confidence'] is None:
+        return '{}: 无满足条件的阈值'.format(head)
+    return '{}: confidence {:.6f}, precision {:.4f}, recall {:.4f}, F1 {:.4f}'.format(
+        head, answer['confidence'], answer['precision_value'], answer['recall_value'], answer['F1_value'])
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+流式读取pkl目录
+
+线程池预读pkl(网络盘上读取受IO限制, 多个线程即可把带宽占满), 正在读取和已读取未处理的pkl
+按文件大小之和限制在max_memory_mb以内; 读到的slide按批返回, 每个slide只保留需要的label,
+并整理为 (N, 5) 的float64数组, 原始的list结果随即释放。
+配置了去重规则时, 在读取线程中对每张slide执行一次box_dedup去重, 去重结果可保存在cache目录中。
+"""
+import collections
+import os
+import sys
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from box_dedup import load_dedup_result
+
+EMPTY_BOXES = np.zeros((0, 5), dtype=np.float64)
+
+
+def compact_result(result, labels=None, min_confidence=None):
+    """
+    :param labels: 需要保留的label, None为全部
+    :param min_confidence: 丢弃置信度低于该值的框, 所有阈值 >= min_confidence 时计数不变
+    :return: {label: (N, 5) float64数组}
+    """
+    compact = {}
+    for label, regions in result.items():
+        if labels is not None and label not in labels:
+            continue
+        boxes = np.array(regions, dtype=np.float64).reshape((-1, 5)) if len(regions) else EMPTY_BOXES
+        if min_confidence is not None:
+            boxes = boxes[boxes[:, 4] >= min_confidence]
+        compact[label] = boxes
+    return compact
+
+
+def iter_pickle_batches(pickle_file_directory, pkl_file_list, workers=8, max_memory_mb=1024, batch_size=64,
+                        labels=None, min_confidence=None, dedup=None):
+    """
+    按pkl_file_list的顺序分批返回slide
+    :param max_memory_mb: 预读中的pkl文件大小之和上限(至少预读一个), pickle解开后的对象通常比文件大数倍
+    :param batch_size: 每批最多的slide数
+    :param dedup: {'rules': 去重规则, 'cache_directory': 去重结果cache目录}, 见box_dedup
+    :return: 生成器, 每次返回 (batch, batch_labels): batch为[(pkl_file, {label: (N, 5)数组}), ...],
+             batch_labels为这批slide中出现过的全部label(包括未保留的)
+    """
+    max_bytes = max_memory_mb * 1024 * 1024
+    path_list = [os.path.join(pickle_file_directory, file) for file in pkl_file_list]
+    size_list = [os.path.getsize(path) for path in path_list]
+    dedup = dedup or {}
+    load = partial(load_dedup_result, dedup_rules=dedup.get('rules'),
+                   cache_directory=dedup.get('cache_directory', ''))
+    pool = ThreadPool(max(1, workers))
+    pending = collections.deque()
+    pending_bytes = 0
+    next_index = 0
+    batch, batch_labels = [], set()
+    try:
+        while next_index < len(path_list) or pending:
+            # 在内存上限内尽量多地提交读取
+            while next_index < len(path_list) and (not pending or pending_bytes + size_list[next_index] <= max_bytes):
+                pending.append((next_index, pool.apply_async(load, (path_list[next_index],))))
+                pending_bytes += size_list[next_index]
+                next_index += 1
+            index, async_result = pending.popleft()
+            result = async_result.get()
+            pending_bytes -= size_list[index]
+            batch_labels.update(result.keys())
+            batch.append((pkl_file_list[index], compact_result(result, labels, min_confidence)))
+            del result
+            if len(batch) >= batch_size:
+                yield batch, batch_labels
+                batch, batch_labels = [], set()
+        if batch:
+            yield batch, batch_labels
+    finally:
+        pool.terminate()
+        pool.join()
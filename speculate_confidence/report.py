@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+结果输出: 曲线图与曲线数据
+
+画图前对曲线降采样: 把曲线按下标分成若干段, 每段保留首尾点以及precision/recall/F1各自的最小、最大值点,
+再加上F1最大值点, 折线的形状和极值不变, 点数不超过约 max_points。
+每个label_group一张precision/recall/F1图、一张FROC图和一张slide级别ROC图, 用非交互的Agg后端
+在多个进程中同时生成, 文件名由group中的label决定。
+曲线数据另存为csv/npz/json, 不需要重新计算或画图即可使用。
+"""
+import csv
+import json
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+import numpy as np
+
+CURVE_KEYS = ('precision_list', 'recall_list', 'F1_list')
+CI_KEYS = ('precision_ci_lower', 'precision_ci_upper', 'recall_ci_lower', 'recall_ci_upper', 'F1_ci_lower',
+           'F1_ci_upper')
+FROC_KEYS = ('fp_per_slide_list', 'sensitivity_list')
+SLIDE_KEYS = ('slide_confidence_list', 'slide_sensitivity_list', 'slide_specificity_list')
+
+DEFAULT_REPORT = {
+    'max_points': 2000,
+    'processes': 0,
+    'dpi': 150,
+    'formats': ['csv', 'npz', 'json'],
+}
+
+
+def get_report_config(report):
+    report_config = dict(DEFAULT_REPORT)
+    report_config.update(report or {})
+    return report_config
+
+
+def downsample_index(curve_list, max_points, keep_index=()):
+    """
+    :param curve_list: 等长的若干条曲线
+    :param max_points: 目标点数, 每段最多保留 2 + 2 * len(curve_list) 个点
+    :param keep_index: 必须保留的下标, 如F1最大值
+    :return: 升序的保留下标
+    """
+    length = len(curve_list[0]) if curve_list else 0
+    if length <= max_points:
+        return np.arange(length)
+    per_bucket = 2 + 2 * len(curve_list)
+    bucket_num = max(1, max_points // per_bucket)
+    edges = np.linspace(0, length, bucket_num + 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    starts, ends = starts[ends > starts], ends[ends > starts]
+    index_list = [starts, ends - 1, np.asarray(keep_index, dtype=np.int64)]
+    for curve in curve_list:
+        curve = np.asarray(curve, dtype=np.float64)
+        # 每段的最小、最大值位置
+        index_list.append(starts + np.array([np.argmin(curve[s:e]) for s, e in zip(starts, ends)], dtype=np.int64))
+        index_list.append(starts + np.array([np.argmax(curve[s:e]) for s, e in zip(starts, ends)], dtype=np.int64))
+    return np.unique(np.concatenate(index_list))
+
+
+def downsample_result(result, max_points):
+    """
+    :return: 画图用的result, 曲线点数不超过约max_points
+    """
+    if len(result['confidence_list']) == 0:
+        return result
+    keep_index = [int(np.argmax(result['F1_list']))]
+    index = downsample_index([result[k] for k in CURVE_KEYS], max_points, keep_index)
+    sampled = dict(result)
+    for k in ('confidence_list',) + CURVE_KEYS + FROC_KEYS:
+        if k in result:
+            sampled[k] = np.asarray(result[k])[index]
+    return sampled
+
+
+def plot_group(plt, group, result_dict, confidence_offset, x_scale):
+    plt.figure(figsize=(12, 6))
+    plt.xlabel('confidence')
+    plt.yticks(np.arange(0, 1, 0.1))
+    plt.xticks(np.arange(confidence_offset, 1, x_scale))
+    for label in group:
+        if label not in result_dict:
+            continue
+        result = result_dict[label]
+        plt.plot(result['confidence_list'], result['precision_list'], color=result['color'], linestyle='solid',
+                 label=label + ': precision')
+        plt.plot(result['confidence_list'], result['recall_list'], color=result['color'], linestyle='dotted',
+                 label=label + ': recall')
+        plt.plot(result['confidence_list'], result['F1_list'], color=result['color'], linestyle='-.',
+                 label=label + ': F1')
+        # bootstrap置信区间
+        if 'ci_confidence_list' in result:
+            for name in ('precision', 'recall', 'F1'):
+                plt.fill_between(result['ci_confidence_list'], result[name + '_ci_lower'],
+                                 result[name + '_ci_upper'], color=result['color'], alpha=0.15, linewidth=0)
+    plt.legend(loc=0)
+
+
+def plot_froc_group(plt, group, result_dict):
+    plt.figure(figsize=(12, 6))
+    plt.xscale('log', base=2)
+    plt.xlabel('average FPs per slide')
+    plt.ylabel('sensitivity')
+    plt.yticks(np.arange(0, 1.1, 0.1))
+    for label in group:
+        if label not in result_dict or 'fp_per_slide_list' not in result_dict[label]:
+            continue
+        result = result_dict[label]
+        fp_per_slide = np.asarray(result['fp_per_slide_list'])
+        # 对数坐标不能显示0
+        positive = fp_per_slide > 0
+        plt.plot(fp_per_slide[positive], np.asarray(result['sensitivity_list'])[positive], color=result['color'],
+                 label='{}: FROC {:.4f}'.format(label, result['froc_score']))
+        plt.scatter(result['froc_fp_rates'], result['froc_sensitivities'], color=result['color'], s=12)
+    plt.legend(loc=0)
+
+
+def plot_slide_roc_group(plt, group, result_dict):
+    plt.figure(figsize=(7, 6))
+    plt.xlabel('1 - specificity')
+    plt.ylabel('sensitivity')
+    plt.plot([0, 1], [0, 1], color='gray', linestyle='dotted')
+    for label in group:
+        if label not in result_dict or 'slide_confidence_list' not in result_dict[label]:
+            continue
+        result = result_dict[label]
+        fpr = np.concatenate(([0.], 1. - np.asarray(result['slide_specificity_list']), [1.]))
+        tpr = np.concatenate(([0.], np.asarray(result['slide_sensitivity_list']), [1.]))
+        plt.plot(fpr, tpr, color=result['color'],
+                 label='{}: AUC {:.4f}'.format(label, result['slide_auc']))
+    plt.legend(loc=4)
+
+
+def get_group_image_name(group, prefix='curve'):
+    return '{}_{}.png'.format(prefix, '_'.join(str(label) for label in group))
+
+
+def _render_group(task):
+    group, result_dict, output_image_path, confidence_offset, x_scale, dpi = task
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    path_list = []
+    plot_group(plt, group, result_dict, confidence_offset, x_scale)
+    path_list.append(os.path.join(output_image_path, get_group_image_name(group)))
+    plt.savefig(path_list[-1], dpi=dpi)
+    plt.close('all')
+    if any('fp_per_slide_list' in result for result in result_dict.values()):
+        plot_froc_group(plt, group, result_dict)
+        path_list.append(os.path.join(output_image_path, get_group_image_name(group, 'froc')))
+        plt.savefig(path_list[-1], dpi=dpi)
+        plt.close('all')
+    if any('slide_confidence_list' in result for result in result_dict.values()):
+        plot_slide_roc_group(plt, group, result_dict)
+        path_list.append(os.path.join(output_image_path, get_group_image_name(group, 'slide_roc')))
+        plt.savefig(path_list[-1], dpi=dpi)
+        plt.close('all')
+    return path_list
+
+
+def render_report(result_list, label_group, output_image_path, confidence_offset, x_scale, report=None):
+    """
+    每个label_group生成precision/recall/F1图、FROC图与slide级别ROC图
+    :return: 图片路径列表
+    """
+    report_config = get_report_config(report)
+    result_dict = {result['label']: downsample_result(result, report_config['max_points']) for result in result_list}
+    tasks = [(group, {label: result_dict[label] for label in group if label in result_dict}, output_image_path,
+              confidence_offset, x_scale, report_config['dpi']) for group in label_group]
+    processes = min(report_config['processes'] or cpu_count(), len(tasks))
+    if processes > 1:
+        pool = Pool(processes)
+        path_lists = pool.map(_render_group, tasks)
+        pool.close()
+        pool.join()
+    else:
+        path_lists = [_render_group(task) for task in tasks]
+    return [path for path_list in path_lists for path in path_list]
+
+
+def _best_F1_point(result):
+    if len(result['confidence_list']) == 0:
+        return None
+    best = int(np.argmax(result['F1_list']))
+    return {'confidence': float(result['confidence_list'][best]), 'precision': float(result['precision_list'][best]),
+            'recall': float(result['recall_list'][best]), 'F1': float(result['F1_list'][best])}
+
+
+def _json_list(values):
+    # json不支持NaN/inf, 非有限值写为null
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isfinite(values), values, None).tolist()
+
+
+def _json_float(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def export_curves(result_list, output_path, formats=('csv', 'npz', 'json')):
+    """
+    curves.csv:  label, confidence, precision, recall, F1, fp_per_slide, sensitivity 每个阈值一行
+    curves.npz:  <label>/confidence 等数组, 包括bootstrap区间、FROC与slide级别曲线
+    curves.json: 每个label的曲线、AP、F1最大值点、FROC与slide级别曲线, NaN/inf写为null
+    :return: 输出文件路径列表
+    """
+    path_list = []
+    if 'csv' in formats:
+        path = os.path.join(output_path, 'curves.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['label', 'confidence', 'precision', 'recall', 'F1', 'fp_per_slide', 'sensitivity'])
+            for result in result_list:
+                froc_columns = [result.get(k, [np.nan] * len(result['confidence_list'])) for k in FROC_KEYS]
+                for row in zip(result['confidence_list'], *([result[k] for k in CURVE_KEYS] + froc_columns)):
+                    writer.writerow([result['label']] + ['%.6g' % i for i in row])
+        path_list.append(path)
+    if 'npz' in formats:
+        path = os.path.join(output_path, 'curves.npz')
+        arrays = {}
+        for result in result_list:
+            for k in ('confidence_list',) + CURVE_KEYS + ('ci_confidence_list',) + CI_KEYS + FROC_KEYS + (
+                    'froc_fp_rates', 'froc_sensitivities', 'froc_score') + SLIDE_KEYS + ('slide_auc',):
+                if k in result:
+                    arrays['{}/{}'.format(result['label'], k)] = np.asarray(result[k], dtype=np.float64)
+        np.savez_compressed(path, **arrays)
+        path_list.append(path)
+    if 'json' in formats:
+        path = os.path.join(output_path, 'curves.json')
+        summary = {}
+        for result in result_list:
+            item = {k: _json_list(result[k])
+                    for k in ('confidence_list',) + CURVE_KEYS + FROC_KEYS + ('froc_fp_rates', 'froc_sensitivities')
+                    + SLIDE_KEYS if k in result}
+            item['best_F1'] = _best_F1_point(result)
+            for k in ('froc_score', 'slide_auc'):
+                if k in result:
+                    item[k] = _json_float(result[k])
+            if 'ap' in result:
+                item['ap'] = _json_float(result['ap'])
+            summary[result['label']] = item
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, allow_nan=False)
+        path_list.append(path)
+    return path_list
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+按输入内容寻址的曲线cache
+
+cache的key由以下内容的sha1组成: 所有pkl(或打包文件)与xml的文件名、修改时间、大小,
+label, confidence_offset, 阈值网格与匹配规则。任一输入变化都会得到新的key, 不会误用旧结果。
+pkl中的label集合也按输入保存, 所有曲线都有cache时不需要读取pkl。
+每条曲线保存为一个npz文件, 目录总大小超过上限时按最近使用时间淘汰。
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 3
+
+
+def get_file_stat_list(directory, file_list):
+    """
+    :return: [(file, mtime, size), ...], 按文件名排序
+    """
+    stat_list = []
+    for file in sorted(file_list):
+        stat = os.stat(os.path.join(directory, file))
+        stat_list.append((file, stat.st_mtime, stat.st_size))
+    return stat_list
+
+
+def get_inputs_fingerprint(pkl_stat_list, xml_stat_list):
+    content = json.dumps({'pkl': pkl_stat_list, 'xml': xml_stat_list}, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_curve_cache_key(inputs_fingerprint, label, confidence_offset, rules):
+    """
+    :param rules: 影响结果的其它配置, 如阈值网格、匹配规则, 需可json序列化
+    """
+    content = json.dumps({'version': CACHE_VERSION, 'inputs': inputs_fingerprint, 'label': label,
+                          'confidence_offset': confidence_offset, 'rules': rules}, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_label_set_cache_key(inputs_fingerprint, label_filter=None):
+    """
+    pkl中label集合的cache key, 所有曲线都有cache时据此得到label而不需要读取pkl
+    :param label_filter: 读取时只保留的label, None为全部
+    """
+    content = json.dumps({'version': CACHE_VERSION, 'inputs': inputs_fingerprint,
+                          'label_filter': sorted(label_filter) if label_filter is not None else None}, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class CurveCache:
+    """
+    result字典中除color外的值都以数组形式保存, 原来是list的读取时还原为list
+    """
+
+    def __init__(self, cache_directory, max_size_mb=1024):
+        self.cache_directory = cache_directory
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        if cache_directory:
+            if not os.path.isdir(cache_directory):
+                os.makedirs(cache_directory)
+            # 上限调小后立即生效
+            self.evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_directory, '{}.npz'.format(key))
+
+    def get(self, key):
+        if not self.cache_directory or not os.path.isfile(self._path(key)):
+            return None
+        path = self._path(key)
+        with np.load(path, allow_pickle=False) as data:
+            list_keys = set(data['__list_keys__'].tolist())
+            result = {}
+            for k in data.files:
+                if k == '__list_keys__':
+                    continue
+                value = data[k]
+                result[k] = value.tolist() if (k in list_keys or value.ndim == 0) else value
+        # 更新访问时间, 用于淘汰
+        os.utime(path, None)
+        return result
+
+    def put(self, key, result):
+        if not self.cache_directory:
+            return
+        arrays, list_keys = {}, []
+        for k, v in result.items():
+            if k == 'color':
+                continue
+            if isinstance(v, list):
+                list_keys.append(k)
+            arrays[k] = np.asarray(v)
+        arrays['__list_keys__'] = np.array(list_keys, dtype=str)
+        tmp_path = self._path(key) + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entry_list = []
+        for file in os.listdir(self.cache_directory):
+            if file.endswith('.npz') and not file.endswith('.tmp.npz'):
+                stat = os.stat(os.path.join(self.cache_directory, file))
+                entry_list.append((stat.st_mtime, stat.st_size, file))
+        total_bytes = sum(i[1] for i in entry_list)
+        # 最久未使用的先删除
+        for mtime, size, file in sorted(entry_list):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_directory, file))
+            total_bytes -= size
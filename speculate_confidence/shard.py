@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+分片模式: 数据量太大时由多个进程或多台机器分别计算, 只需共享同一个目录
+
+map:   每个分片只处理 hash(slide名) % shard_count == shard_index 的slide, 在固定阈值轴上计算每张slide的
+       计数直方图, 保存为 directory/shard_<index>_of_<count>, 格式与增量模式的SlideHistogramStore相同,
+       重新运行时分片内也只计算新增或修改过的slide
+merge: 读取所有分片, 汇总直方图相加, 每张slide的直方图按slide名从对应分片读取。
+       计数是整数直方图之和, 与单机增量模式(相同confidence_offset与step)的结果完全相同
+"""
+import hashlib
+import os
+
+from slide_histogram import SlideHistogramStore
+
+
+def get_shard_index(file, shard_count):
+    """
+    按slide名(不含扩展名)的sha1分片, 与机器、进程和文件顺序无关
+    """
+    file_name = file.split('.')[0]
+    return int(hashlib.sha1(file_name.encode('utf-8')).hexdigest(), 16) % shard_count
+
+
+def get_shard_directory(directory, shard_index, shard_count):
+    return os.path.join(directory, 'shard_{}_of_{}'.format(shard_index, shard_count))
+
+
+def get_shard_filter(shard_index, shard_count):
+    """
+    :return: file_filter, 文件(pkl或xml)属于该分片时为True
+    """
+    return lambda file: get_shard_index(file, shard_count) == shard_index
+
+
+def check_shard(shard_index, shard_count):
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise Exception('Invalid shard {} of {}'.format(shard_index, shard_count))
+
+
+def run_shard(directory, shard_index, shard_count, pickle_file_directory, xml_region_index, confidence_offset, step,
+              workers=1, max_memory_mb=1024, dedup=None):
+    """
+    计算一个分片
+    :return: SlideHistogramStore, 新增/修改的slide个数, 删除的slide个数
+    """
+    check_shard(shard_index, shard_count)
+    dedup_rules = (dedup or {}).get('rules')
+    store = SlideHistogramStore(get_shard_directory(directory, shard_index, shard_count), confidence_offset, step,
+                                dedup_rules)
+    changed_num, removed_num = store.update(pickle_file_directory, xml_region_index, workers, max_memory_mb, dedup,
+                                            get_shard_filter(shard_index, shard_count))
+    return store, changed_num, removed_num
+
+
+class ShardedHistogramStore(SlideHistogramStore):
+    """
+    所有分片合并后的只读SlideHistogramStore, 可直接用于曲线、bootstrap与工作点计算
+    """
+
+    def __init__(self, directory, shard_count, confidence_offset, step, dedup_rules=None):
+        check_shard(0, shard_count)
+        self.directory = directory
+        self.shard_count = shard_count
+        self.shard_stores = []
+        for shard_index in range(shard_count):
+            store = SlideHistogramStore(get_shard_directory(directory, shard_index, shard_count), confidence_offset,
+                                        step, dedup_rules)
+            # 分片未运行, 或阈值轴、去重规则与合并时不一致
+            if not store.loaded:
+                raise Exception('Shard {} of {} in {} is missing or has a different threshold axis'.format(
+                    shard_index, shard_count, directory))
+            for file in store.manifest:
+                if get_shard_index(file, shard_count) != shard_index:
+                    raise Exception('{} does not belong to shard {} of {}'.format(file, shard_index, shard_count))
+            self.shard_stores.append(store)
+        self.axis = self.shard_stores[0].axis
+        self.axis_signature = self.shard_stores[0].axis_signature
+        self.aggregate = {}
+        self.manifest = {}
+        self.slide_summary = {}
+        self._slide_histograms = None
+        for store in self.shard_stores:
+            self._add(store.aggregate, 1)
+            self.manifest.update(store.manifest)
+            self.slide_summary.update(store.slide_summary)
+        self.loaded = True
+
+    def load_slide_histogram(self, file):
+        return self.shard_stores[get_shard_index(file, self.shard_count)].load_slide_histogram(file)
+
+    def update(self, *args, **kwargs):
+        raise Exception('ShardedHistogramStore is read-only, run each shard instead')
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+检测结果目录: 每个pkl只读取一次, 读取的同时整理出label集合与每个label的置信度数组,
+之后的各个计算阶段都从这里取数据
+"""
+import os
+
+import numpy as np
+
+from pkl_stream import iter_pickle_batches
+
+
+def get_pickle_file_list(pickle_directory):
+    pickle_file_list = []
+    for root, dirs, files in os.walk(pickle_directory):
+        for file in files:
+            if file.split('.')[-1].lower() == 'pkl':
+                pickle_file_list.append(file)
+    return pickle_file_list
+
+
+class SlideCatalog:
+    """
+    pkl_file_list: slide的文件名列表, 与原pkl文件名一致
+    results: {pkl_file: {label: regions}}, 也可以是DetectionStore.results()的只读映射
+    labels: 所有slide中出现过的label, 读取时指定了labels的只包含其中保留的label
+    store_path: 来自DetectionStore时为文件路径, 多进程计算时各进程自己打开, 否则为None
+    """
+
+    def __init__(self, pkl_file_list, results, labels, label_scores, store_path=None):
+        self.pkl_file_list = list(pkl_file_list)
+        self.results = results
+        self.labels = set(labels)
+        self._label_scores = label_scores
+        self.store_path = store_path
+
+    @classmethod
+    def from_pickle_directory(cls, pickle_file_directory, workers=1, pkl_file_list=None, labels=None,
+                              min_confidence=None, max_memory_mb=1024, dedup=None):
+        """
+        :param workers: 读取pkl的线程数, 网络盘上读取受IO限制, 多线程即可并行
+        :param labels: 只保留这些label的框, None为全部
+        :param min_confidence: 只保留置信度 >= min_confidence 的框
+        :param max_memory_mb: 预读中的pkl文件大小上限, 见pkl_stream.iter_pickle_batches
+        :param dedup: 读取时的去重规则与cache目录, 见pkl_stream.iter_pickle_batches
+        """
+        if pkl_file_list is None:
+            pkl_file_list = get_pickle_file_list(pickle_file_directory)
+        labels = set(labels) if labels is not None else None
+        results, score_lists, all_labels = {}, {}, set()
+        for batch, batch_labels in iter_pickle_batches(pickle_file_directory, pkl_file_list, workers, max_memory_mb,
+                                                       labels=labels, min_confidence=min_confidence, dedup=dedup):
+            all_labels.update(batch_labels)
+            for file, result in batch:
+                results[file] = result
+                for label, boxes in result.items():
+                    score_lists.setdefault(label, []).append(boxes[:, 4])
+        label_scores = {label: np.sort(np.concatenate(v)) for label, v in score_lists.items()}
+        # 只报告实际保留的label, 未保留的label在results中不存在
+        if labels is not None:
+            all_labels &= labels
+        return cls(pkl_file_list, results, all_labels, label_scores)
+
+    @classmethod
+    def from_store(cls, detection_store):
+        label_scores = {}
+        for label in detection_store.labels:
+            boxes, _ = detection_store.label_boxes(label)
+            label_scores[label] = np.sort(np.asarray(boxes[:, 4], dtype=np.float64))
+        return cls(detection_store.slides, detection_store.results(), detection_store.labels, label_scores,
+                   detection_store.store_path)
+
+    def __len__(self):
+        return len(self.pkl_file_list)
+
+    def label_scores(self, label):
+        """
+        :return: 所有slide中该label的置信度, 升序
+        """
+        return self._label_scores.get(label, np.zeros(0))
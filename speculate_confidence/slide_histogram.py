@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+按slide保存的计数直方图, 用于slide增删改时增量更新曲线
+
+阈值轴固定为 confidence_offset + step * k (k = 0, 1, ...), 与数据无关, 所有slide共用。
+每张slide每个label保存三个直方图: 检测框置信度、TP1命中置信度、医生框TP2命中置信度落在哪个阈值区间,
+以及医生框个数。某个阈值下的TP1/TP2/FP/FN即为直方图从该阈值往上的累计和, 对slide可加。
+新增、删除或修改slide时只需对变化的slide重新计算, 并在汇总直方图上加减。
+
+aggregate.npz中同时保存每张slide每个label最高的SLIDE_TOP_K个检测框所在的阈值区间与医生框个数,
+slide级别的结果不需要读取每张slide的直方图; 只有bootstrap(或top_k > SLIDE_TOP_K)才读取, 每次运行每个文件只读取一次。
+
+目录结构:
+    directory/aggregate.npz                    汇总直方图、每张slide的top-k区间与已计入的slide清单
+    directory/slides/<pkl>.<fingerprint>.npz   每张slide的直方图, 文件名包含计算时pkl与xml的指纹
+
+slide修改后新的直方图写到新文件名, 保存aggregate.npz之后才删除旧文件, 中途中断时aggregate.npz
+与清单中指纹对应的旧直方图仍然一致, 下次运行重新计算即可。
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from confidence_sweep import SlideOverlap
+from pkl_stream import iter_pickle_batches
+from slide_catalog import get_pickle_file_list
+from slide_level import slide_scores_from_kept
+
+EMPTY_REGIONS = np.zeros((0, 4), dtype=np.float64)
+# 目录格式变化时之前的直方图全部作废
+STORE_VERSION = 4
+# aggregate.npz中为每张slide保存的最高检测框个数, 即不读取slide直方图时支持的最大top_k
+SLIDE_TOP_K = 10
+
+
+def get_threshold_axis(confidence_offset, step):
+    point_num = int(np.floor((1. - confidence_offset) / step + 1e-9)) + 1
+    return confidence_offset + step * np.arange(point_num)
+
+
+def bin_scores(axis, scores):
+    """
+    每个分数落在的阈值区间, 小于axis[0]的为-1
+    """
+    return np.searchsorted(axis, scores, side='right') - 1
+
+
+def slide_overlap_histogram(axis, slide_overlap):
+    """
+    :return: (3, len(axis)) 依次为检测框、TP1、TP2的直方图
+    """
+    hist = np.zeros((3, len(axis)), dtype=np.int64)
+    for row, scores in enumerate((slide_overlap.scores, slide_overlap.scores[slide_overlap.det_hit],
+                                  slide_overlap.gt_best_scores)):
+        bins = bin_scores(axis, scores)
+        bins = bins[bins >= 0]
+        hist[row] = np.bincount(bins, minlength=len(axis))
+    return hist
+
+
+def histogram_to_counts(hist, gt_num):
+    """
+    :param hist: (..., 3, T)直方图
+    :return: TP1, TP2, FP, FN, 形状为(..., T)
+    """
+    cumulative = np.cumsum(hist[..., ::-1], axis=-1)[..., ::-1]
+    kept, TP1, TP2 = cumulative[..., 0, :], cumulative[..., 1, :], cumulative[..., 2, :]
+    FP = kept - TP1
+    FN = np.asarray(gt_num)[..., None] - TP2
+    return TP1, TP2, FP, FN
+
+
+def top_bins(det_hist, k):
+    """
+    :param det_hist: 检测框的直方图
+    :return: 最高的k个检测框所在的阈值区间(降序), 不足k个的记为-1
+    """
+    bins = np.repeat(np.arange(len(det_hist)), det_hist)[::-1][:k]
+    result = np.full(k, -1, dtype=np.int32)
+    result[:len(bins)] = bins
+    return result
+
+
+def _slide_fingerprint(pickle_file_directory, file, xml_record):
+    stat = os.stat(os.path.join(pickle_file_directory, file))
+    return [stat.st_mtime, stat.st_size, xml_record[0], xml_record[1]]
+
+
+class SlideHistogramStore:
+
+    def __init__(self, directory, confidence_offset, step, dedup_rules=None):
+        self.directory = directory
+        self.slide_directory = os.path.join(directory, 'slides')
+        if not os.path.isdir(self.slide_directory):
+            os.makedirs(self.slide_directory)
+        self.axis = get_threshold_axis(confidence_offset, step)
+        # 阈值轴或去重规则变化时之前的直方图全部作废
+        self.axis_signature = [confidence_offset, step, dedup_rules or {}]
+        # {label: [hist(3, T), gt_num]}
+        self.aggregate = {}
+        # {pkl_file: fingerprint}
+        self.manifest = {}
+        # {pkl_file: {label: [top_bins(SLIDE_TOP_K,), gt_num]}}
+        self.slide_summary = {}
+        # 读取过的slide直方图, {label: [hist(slide数, 3, T), gt_num(slide数,)]}, slide按文件名排序
+        self._slide_histograms = None
+        # aggregate.npz存在且阈值轴一致时为True
+        self.loaded = self._load_aggregate()
+
+    @property
+    def labels(self):
+        return set(self.aggregate.keys())
+
+    @property
+    def aggregate_path(self):
+        return os.path.join(self.directory, 'aggregate.npz')
+
+    def _slide_path(self, file, fingerprint):
+        key = hashlib.sha1(json.dumps(fingerprint).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.slide_directory, '{}.{}.npz'.format(file, key))
+
+    def _load_aggregate(self):
+        if not os.path.isfile(self.aggregate_path):
+            return False
+        with np.load(self.aggregate_path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            # 阈值轴或目录格式变化时之前的直方图全部作废
+            if meta.get('version') != STORE_VERSION or meta['axis_signature'] != self.axis_signature:
+                return False
+            labels = data['labels'].tolist()
+            for label, hist, gt_num in zip(labels, data['hist'], data['gt_num']):
+                self.aggregate[label] = [hist.astype(np.int64), int(gt_num)]
+            slide_top_bins, slide_gt_num = data['slide_top_bins'], data['slide_gt_num']
+            for row, file in enumerate(data['slide_files'].tolist()):
+                self.slide_summary[file] = {label: [slide_top_bins[l, row], int(slide_gt_num[l, row])]
+                                            for l, label in enumerate(labels)}
+        self.manifest = meta['manifest']
+        return True
+
+    def _save_aggregate(self):
+        labels = sorted(self.aggregate.keys())
+        hist = np.array([self.aggregate[label][0] for label in labels], dtype=np.int64).reshape(
+            (len(labels), 3, len(self.axis)))
+        gt_num = np.array([self.aggregate[label][1] for label in labels], dtype=np.int64)
+        files = sorted(self.manifest.keys())
+        slide_top_bins = np.full((len(labels), len(files), SLIDE_TOP_K), -1, dtype=np.int32)
+        slide_gt_num = np.zeros((len(labels), len(files)), dtype=np.int64)
+        for l, label in enumerate(labels):
+            for row, file in enumerate(files):
+                if label in self.slide_summary[file]:
+                    slide_top_bins[l, row], slide_gt_num[l, row] = self.slide_summary[file][label]
+        meta = json.dumps({'version': STORE_VERSION, 'axis_signature': self.axis_signature,
+                           'manifest': self.manifest})
+        tmp_path = self.aggregate_path + '.tmp.npz'
+        np.savez(tmp_path, labels=np.array(labels, dtype=str), hist=hist, gt_num=gt_num,
+                 slide_files=np.array(files, dtype=str), slide_top_bins=slide_top_bins, slide_gt_num=slide_gt_num,
+                 meta=np.array(meta))
+        os.replace(tmp_path, self.aggregate_path)
+
+    def load_slide_histogram(self, file):
+        """
+        :return: {label: (hist(3, T), gt_num)}
+        """
+        with np.load(self._slide_path(file, self.manifest[file]), allow_pickle=False) as data:
+            return {label: (hist, int(gt_num))
+                    for label, hist, gt_num in zip(data['labels'].tolist(), data['hist'], data['gt_num'])}
+
+    def _save_slide_histogram(self, file, fingerprint, label_histogram):
+        labels = sorted(label_histogram.keys())
+        hist = np.array([label_histogram[label][0] for label in labels], dtype=np.int32).reshape(
+            (len(labels), 3, len(self.axis)))
+        gt_num = np.array([label_histogram[label][1] for label in labels], dtype=np.int64)
+        np.savez(self._slide_path(file, fingerprint), labels=np.array(labels, dtype=str), hist=hist, gt_num=gt_num)
+
+    def _add(self, label_histogram, sign):
+        for label, (hist, gt_num) in label_histogram.items():
+            if label not in self.aggregate:
+                self.aggregate[label] = [np.zeros((3, len(self.axis)), dtype=np.int64), 0]
+            self.aggregate[label][0] += sign * hist.astype(np.int64)
+            self.aggregate[label][1] += sign * gt_num
+
+    def slide_histogram(self, result, doctor_label_regions):
+        """
+        计算单张slide中pkl所有label的直方图, 与pkl模式相同, 只在xml中出现的label不计入, xml中没有的label按没有医生框处理
+        """
+        label_histogram = {}
+        for label, boxes in result.items():
+            slide_overlap = SlideOverlap(boxes, doctor_label_regions.get(label, EMPTY_REGIONS))
+            label_histogram[label] = (slide_overlap_histogram(self.axis, slide_overlap), slide_overlap.gt_num)
+        return label_histogram
+
+    def update(self, pickle_file_directory, xml_region_index, workers=1, max_memory_mb=1024, dedup=None,
+               file_filter=None):
+        """
+        与pkl目录当前内容同步, 只读取新增或修改过的pkl
+        :param file_filter: 不为None时只同步file_filter(file)为True的pkl, 如分片模式下属于本分片的slide
+        :return: 新增/修改的slide个数, 删除的slide个数
+        """
+        file_list = get_pickle_file_list(pickle_file_directory)
+        if file_filter is not None:
+            file_list = [file for file in file_list if file_filter(file)]
+        xml_records = {os.path.basename(path).split('.')[0]: record
+                       for path, record in xml_region_index.file_records.items()}
+        fingerprint_dict = {}
+        for file in file_list:
+            file_name = file.split('.')[0]
+            if file_name not in xml_records:
+                raise Exception('No {} doctor xml'.format(file_name))
+            fingerprint_dict[file] = _slide_fingerprint(pickle_file_directory, file, xml_records[file_name])
+
+        removed_list = [file for file in self.manifest if fingerprint_dict.get(file) != self.manifest[file]]
+        changed_list = [file for file in file_list if self.manifest.get(file) != fingerprint_dict[file]]
+        if removed_list or changed_list:
+            self._slide_histograms = None
+        for file in removed_list:
+            self._add(self.load_slide_histogram(file), -1)
+            del self.manifest[file]
+            del self.slide_summary[file]
+
+        # 低于阈值轴起点的框不进入任何直方图, 读取时直接丢弃
+        for batch, _ in iter_pickle_batches(pickle_file_directory, changed_list, workers, max_memory_mb,
+                                            min_confidence=self.axis[0], dedup=dedup):
+            for file, result in batch:
+                label_histogram = self.slide_histogram(result, xml_region_index.regions[file.split('.')[0]])
+                self._save_slide_histogram(file, fingerprint_dict[file], label_histogram)
+                self._add(label_histogram, 1)
+                self.manifest[file] = fingerprint_dict[file]
+                self.slide_summary[file] = {label: [top_bins(hist[0], SLIDE_TOP_K), gt_num]
+                                            for label, (hist, gt_num) in label_histogram.items()}
+
+        # 没有slide时也保存, 分片合并时据此确认分片已完成
+        if removed_list or changed_list or not self.loaded:
+            self._save_aggregate()
+            self.loaded = True
+            self._remove_stale_slides()
+        return len(changed_list), len([file for file in removed_list if file not in fingerprint_dict])
+
+    def _remove_stale_slides(self):
+        """
+        删除清单中没有的直方图文件: 已删除或修改前的slide, 以及之前中断时留下的文件
+        """
+        keep = set(os.path.basename(self._slide_path(file, fingerprint)) for file, fingerprint in self.manifest.items())
+        for name in os.listdir(self.slide_directory):
+            if name not in keep:
+                os.remove(os.path.join(self.slide_directory, name))
+
+    def counts(self, label):
+        """
+        :return: 阈值轴, 以及每个阈值下的TP1, TP2, FP, FN
+        """
+        hist, gt_num = self.aggregate[label]
+        return (self.axis,) + histogram_to_counts(hist, gt_num)
+
+    def _load_slide_histograms(self):
+        """
+        读取所有slide的直方图, 每个文件只读取一次, 供所有label使用
+        """
+        if self._slide_histograms is None:
+            files = sorted(self.manifest.keys())
+            slide_histograms = {}
+            for row, file in enumerate(files):
+                for label, (hist, gt_num) in self.load_slide_histogram(file).items():
+                    if label not in slide_histograms:
+                        slide_histograms[label] = [np.zeros((len(files), 3, len(self.axis)), dtype=np.int32),
+                                                   np.zeros(len(files), dtype=np.int64)]
+                    slide_histograms[label][0][row] = hist
+                    slide_histograms[label][1][row] = gt_num
+            self._slide_histograms = slide_histograms
+        return self._slide_histograms
+
+    def slide_counts(self, label, confidences):
+        """
+        每张slide分别计数, confidences需取自阈值轴
+        :return: TP1, TP2, FP, FN, 形状均为(slide数, 阈值数)
+        """
+        index = np.searchsorted(self.axis, np.asarray(confidences) - 1e-9, side='left')
+        slide_histograms = self._load_slide_histograms()
+        if label in slide_histograms:
+            hist, gt_num = slide_histograms[label]
+        else:
+            hist = np.zeros((len(self.manifest), 3, len(self.axis)), dtype=np.int32)
+            gt_num = np.zeros(len(self.manifest), dtype=np.int64)
+        return tuple(counts[:, index] for counts in histogram_to_counts(hist, gt_num))
+
+    def slide_scores(self, label, top_k=1):
+        """
+        slide级别的分数(取阈值轴上的值)与是否阳性, 见slide_level.slide_scores_from_kept
+        """
+        if top_k > SLIDE_TOP_K:
+            TP1, TP2, FP, FN = self.slide_counts(label, self.axis)
+            return slide_scores_from_kept(self.axis, TP1 + FP, (TP2 + FN)[:, 0], top_k)
+        bins = np.full(len(self.manifest), -1, dtype=np.int64)
+        gt_num = np.zeros(len(self.manifest), dtype=np.int64)
+        for row, file in enumerate(sorted(self.manifest.keys())):
+            if label in self.slide_summary[file]:
+                bins[row] = self.slide_summary[file][label][0][top_k - 1]
+                gt_num[row] = self.slide_summary[file][label][1]
+        return np.where(bins >= 0, self.axis[np.maximum(bins, 0)], -np.inf), gt_num > 0
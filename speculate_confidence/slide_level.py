@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+slide级别的sensitivity/specificity/ROC-AUC
+
+有该label医生框的slide为阳性。每张slide取第top_k高的检测框置信度作为slide分数(top_k=1即最大值),
+阈值为c时slide判为阳性 <=> 置信度 >= c 的检测框至少top_k个 <=> slide分数 >= c,
+检测框不足top_k个的slide分数为-inf。所有阈值下的结果由slide分数排序后一次得到。
+"""
+import numpy as np
+
+DEFAULT_SLIDE_LEVEL = {
+    'top_k': 1,
+}
+
+
+def get_slide_level_config(slide_level):
+    slide_level_config = dict(DEFAULT_SLIDE_LEVEL)
+    slide_level_config.update(slide_level or {})
+    return slide_level_config
+
+
+def slide_scores_from_overlap(label_overlap, top_k=1, confidence_offset=None):
+    """
+    :param confidence_offset: 低于该值的分数记为-inf, 与读取pkl时丢弃的框以及增量模式的阈值轴起点一致
+    :return: slide分数, slide是否阳性
+    """
+    slide_list = list(label_overlap.slides.values())
+    scores = np.array([i.scores[top_k - 1] if len(i.scores) >= top_k else -np.inf for i in slide_list],
+                      dtype=np.float64)
+    if confidence_offset is not None:
+        scores[scores < confidence_offset] = -np.inf
+    positive = np.array([i.gt_num > 0 for i in slide_list], dtype=bool)
+    return scores, positive
+
+
+def slide_scores_from_kept(axis, kept, gt_num, top_k=1):
+    """
+    由每张slide在阈值轴上保留的框数得到slide分数(取阈值轴上的值)
+    :param kept: (slide数, len(axis)), 随阈值单调不增
+    """
+    reached = np.sum(np.asarray(kept) >= top_k, axis=-1)
+    scores = np.where(reached > 0, np.asarray(axis)[np.maximum(reached - 1, 0)], -np.inf)
+    return scores, np.asarray(gt_num) > 0
+
+
+def slide_roc(scores, positive):
+    """
+    :return: 阈值(降序), 各阈值下的sensitivity, specificity, 以及ROC-AUC
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    positive = np.asarray(positive, dtype=bool)
+    positive_num, negative_num = int(positive.sum()), int((~positive).sum())
+    thresholds = np.unique(scores[np.isfinite(scores)])[::-1]
+    # 分数 >= 阈值的阳性/阴性slide个数
+    positive_scores = np.sort(scores[positive])
+    negative_scores = np.sort(scores[~positive])
+    true_positive = len(positive_scores) - np.searchsorted(positive_scores, thresholds, side='left')
+    false_positive = len(negative_scores) - np.searchsorted(negative_scores, thresholds, side='left')
+    sensitivity = true_positive / float(max(positive_num, 1))
+    specificity = 1. - false_positive / float(max(negative_num, 1))
+
+    # Mann-Whitney: 阳性分数高于阴性的比例, 相等记0.5
+    if positive_num and negative_num:
+        below = np.searchsorted(negative_scores, positive_scores, side='left')
+        equal = np.searchsorted(negative_scores, positive_scores, side='right') - below
+        auc = float(np.sum(below + 0.5 * equal)) / (positive_num * negative_num)
+    else:
+        auc = float('nan')
+    return thresholds, sensitivity, specificity, auc
+
+
+def add_slide_level_curve(result_dict, scores, positive):
+    thresholds, sensitivity, specificity, auc = slide_roc(scores, positive)
+    result_dict['slide_confidence_list'] = thresholds
+    result_dict['slide_sensitivity_list'] = sensitivity
+    result_dict['slide_specificity_list'] = specificity
+    result_dict['slide_auc'] = auc
+    return result_dict
@@ -1,120 +1,107 @@
 # -*- coding: utf-8 -*-
 import argparse
-import datetime
 import os
-import pickle
-import random
+import sys
 import time
-import xml.etree.cElementTree as ET
-from functools import partial
-from multiprocessing import cpu_count
-from multiprocessing.pool import Pool
 
-import matplotlib.pyplot as plt
-import numpy as np
 import yaml
 
-OFFSET = 1e-8
+from bootstrap import add_bootstrap_interval
+from confidence_sweep import (LabelOverlap, build_label_overlaps, get_match_rule, get_match_rule_name,
+                              sweep_counts)
+from froc import add_froc_curve
+from operating_point import OperatingPointSolver, format_operating_point, solve_operating_points
+from report import downsample_result, export_curves, get_report_config, plot_group, render_report
+from result_cache import (CurveCache, get_curve_cache_key, get_file_stat_list, get_inputs_fingerprint,
+                          get_label_set_cache_key)
+from shard import ShardedHistogramStore, check_shard, get_shard_filter, run_shard
+from slide_catalog import SlideCatalog, get_pickle_file_list
+from slide_histogram import SlideHistogramStore
+from slide_level import add_slide_level_curve, get_slide_level_config, slide_scores_from_overlap
+from threshold_grid import build_threshold_grid, refine_threshold_grid
+from xml_index import XmlRegionIndex
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from average_precision import batch_average_precision
+from detection_store import DetectionStore
 
+OFFSET = 1e-8
 
-def parse_xml(xml_path, target_label):
-    root = ET.parse(xml_path)
-    objects = root.findall('object')
-    annotation_list = []
-    for obj in objects:
-        label = obj.find('name').text
-        if label == target_label:
-            bbox_doc = obj.find('bndbox')
-            x1 = float(bbox_doc.find('xmin').text)
-            y1 = float(bbox_doc.find('ymin').text)
-            x2 = float(bbox_doc.find('xmax').text)
-            y2 = float(bbox_doc.find('ymax').text)
-            bbox = [x1, y1, x2, y2]
-            annotation_list.append(bbox)
-    return annotation_list
-
-
-def get_all_xml_regions_of_target_label(xml_file_directory, target_label):
-    file_list = os.listdir(xml_file_directory)
-    xml_file_list = []
-    for file in file_list:
-        if file.split('.')[-1].lower() == 'xml':
-            xml_file_list.append(file)
-    dict = {}
-    for xml_file in xml_file_list:
-        xml_path = os.path.join(xml_file_directory, xml_file)
-        regions = parse_xml(xml_path, target_label)
-        file_name = xml_file.split('.')[0]
-        dict[file_name] = regions
-    return dict
-
-
-def calc_pre_recall_F1_by_fixed_conf(confidence, all_pkl_result_dict, pkl_file_list, doctor_regions_dict,
-                                     target_label):
-    Total_TP1, Total_TP2, Total_FP, Total_FN = 0, 0, 0, 0
-    for file in pkl_file_list:
-        file_name = file.split('.')[0]
-        try:
-            doctor_region_list = doctor_regions_dict[file_name]
-        except KeyError:
-            msg = 'No {} doctor xml'.format(file_name)
-            raise Exception(msg)
-        result = all_pkl_result_dict[file]
-        computer_region_list = result[target_label]
-        TP1, TP2, FP, FN = handle_result(computer_region_list, doctor_region_list, confidence)
-        Total_TP1 += TP1
-        Total_TP2 += TP2
-        Total_FP += FP
-        Total_FN += FN
-    precision = calc_precision(Total_TP1, Total_FP)
-    recall = calc_recall(Total_TP2, Total_FN)
-    F1 = calc_F1(precision, recall)
-    return precision, recall, F1
-
-
-def get_precisions_recalls_F1s_by_confidences(sorted_confidence_list, all_pkl_result_dict, pkl_file_list,
-                                              doctor_regions_dict, target_label):
-    _calc_pre_recall_F1_by_fixed_conf = partial(calc_pre_recall_F1_by_fixed_conf,
-                                                all_pkl_result_dict=all_pkl_result_dict,
-                                                pkl_file_list=pkl_file_list,
-                                                doctor_regions_dict=doctor_regions_dict, target_label=target_label)
-    pool = Pool(cpu_count())
-    precision_recall_F1_list = pool.map(_calc_pre_recall_F1_by_fixed_conf, sorted_confidence_list)
-    pool.close()
-    pool.join()
 
+def get_precisions_recalls_F1s_by_counts(TP1_list, TP2_list, FP_list, FN_list):
     precision_list, recall_list, F1_list = [], [], []
-    for i in precision_recall_F1_list:
-        precision_list.append(i[0])
-        recall_list.append(i[1])
-        F1_list.append(i[2])
+    for TP1, TP2, FP, FN in zip(TP1_list, TP2_list, FP_list, FN_list):
+        precision = calc_precision(TP1, FP)
+        recall = calc_recall(TP2, FN)
+        precision_list.append(precision)
+        recall_list.append(recall)
+        F1_list.append(calc_F1(precision, recall))
     return precision_list, recall_list, F1_list
 
 
-def for_each_pickle_file(pickle_file_directory, xml_file_directory, target_label, confidence_offset,
-                         all_pkl_result_dict):
-    pkl_file_list = get_pickle_file_list(pickle_file_directory)
+def for_each_pickle_file(slide_catalog, xml_region_index, target_label, confidence_offset, label_overlap=None,
+                         threshold_grid=None, bootstrap=None, froc=None, slide_level=None):
     # 获取所有image的置信度列表
-    sorted_confidence_list = get_all_image_region_confidence(pickle_file_directory, target_label)
+    all_confidence_list = slide_catalog.label_scores(target_label)
     ###############################################################################
     # 截取部分confidence在0.6以上的部分
-    sorted_confidence_list = np.array(sorted_confidence_list)
-    sorted_confidence_list = sorted_confidence_list[sorted_confidence_list >= confidence_offset]
+    all_confidence_list = all_confidence_list[all_confidence_list >= confidence_offset]
+    # 按threshold_grid取阈值, 默认exact即所有置信度
+    sorted_confidence_list = build_threshold_grid(all_confidence_list, confidence_offset, threshold_grid)
     print('confidence_length', len(sorted_confidence_list))
     ###############################################################################
 
-    # 先将所有的doctor_xml文件中target_label对应的regions整理成字典{'file1': [], 'file2': [], ...}
-    all_doctor_xml_regions_for_single_label = get_all_xml_regions_of_target_label(xml_file_directory, target_label)
-
     print('开始计算')
     start_time = time.time()
 
-    precision_list, recall_list, F1_list = get_precisions_recalls_F1s_by_confidences(sorted_confidence_list,
-                                                                                     all_pkl_result_dict,
-                                                                                     pkl_file_list,
-                                                                                     all_doctor_xml_regions_for_single_label,
-                                                                                     target_label)
+    # all_labels_at_once模式下label_overlap已经由build_label_overlaps统一计算
+    if label_overlap is None:
+        # 先将所有的doctor_xml文件中target_label对应的regions整理成字典{'file1': [], 'file2': [], ...}
+        all_doctor_xml_regions_for_single_label = xml_region_index.regions_of_label(target_label)
+        label_overlap = LabelOverlap.from_results(slide_catalog.results, slide_catalog.pkl_file_list,
+                                                  all_doctor_xml_regions_for_single_label, target_label)
+    # 每张slide只计算一次相交, 之后所有阈值由累计计数得到
+    TP1_list, TP2_list, FP_list, FN_list = sweep_counts(sorted_confidence_list, label_overlap)
+    precision_list, recall_list, F1_list = get_precisions_recalls_F1s_by_counts(TP1_list, TP2_list, FP_list, FN_list)
+    # 在F1最大值与目标precision/recall附近用实际置信度精确计算
+    refined_confidence_list = refine_threshold_grid(sorted_confidence_list, all_confidence_list, precision_list,
+                                                    recall_list, F1_list, threshold_grid)
+    if len(refined_confidence_list) != len(sorted_confidence_list):
+        sorted_confidence_list = refined_confidence_list
+        print('refined confidence_length', len(sorted_confidence_list))
+        TP1_list, TP2_list, FP_list, FN_list = sweep_counts(sorted_confidence_list, label_overlap)
+        precision_list, recall_list, F1_list = get_precisions_recalls_F1s_by_counts(TP1_list, TP2_list, FP_list,
+                                                                                    FN_list)
+    result_dict = build_result_dict(target_label, sorted_confidence_list, precision_list, recall_list, F1_list)
+    # FROC与precision/recall使用同一组计数
+    add_froc_curve(result_dict, TP2_list, FP_list, label_overlap.gt_num, len(label_overlap.slides), froc)
+    # slide级别的sensitivity/specificity, 由每张slide第top_k高的置信度得到
+    top_k = get_slide_level_config(slide_level)['top_k']
+    if top_k > 0:
+        add_slide_level_curve(result_dict, *slide_scores_from_overlap(label_overlap, top_k, confidence_offset))
+    # 按slide重采样得到precision/recall/F1的置信区间
+    add_bootstrap_interval(result_dict, label_overlap.slide_counts, bootstrap)
     print('用时{}s'.format(time.time() - start_time))
+    return result_dict
+
+
+def for_each_label_histogram(slide_histogram_store, target_label, bootstrap=None, froc=None, slide_level=None):
+    # 增量模式: 直接由汇总直方图得到阈值轴上的计数
+    confidence_list, TP1_list, TP2_list, FP_list, FN_list = slide_histogram_store.counts(target_label)
+    precision_list, recall_list, F1_list = get_precisions_recalls_F1s_by_counts(TP1_list, TP2_list, FP_list, FN_list)
+    result_dict = build_result_dict(target_label, confidence_list, precision_list, recall_list, F1_list)
+    add_froc_curve(result_dict, TP2_list, FP_list, slide_histogram_store.aggregate[target_label][1],
+                   len(slide_histogram_store.manifest), froc)
+    top_k = get_slide_level_config(slide_level)['top_k']
+    if top_k > 0:
+        # slide分数精确到阈值轴的步长, 由aggregate.npz中每张slide的top-k区间得到
+        add_slide_level_curve(result_dict, *slide_histogram_store.slide_scores(target_label, top_k))
+    return add_bootstrap_interval(result_dict,
+                                  lambda confidences: slide_histogram_store.slide_counts(target_label, confidences),
+                                  bootstrap)
+
+
+def build_result_dict(target_label, sorted_confidence_list, precision_list, recall_list, F1_list):
     result_dict = {}
     result_dict['label'] = target_label
     result_dict['confidence_list'] = sorted_confidence_list
@@ -124,117 +111,22 @@ def for_each_pickle_file(pickle_file_directory, xml_file_directory, target_label
     return result_dict
 
 
-def get_all_pkl_result_dict(pickle_file_directory, pkl_file_list):
-    dict = {}
-    for file in pkl_file_list:
-        with open(os.path.join(pickle_file_directory, file), 'rb') as f:
-            result = pickle.load(f)
-            dict[file] = result
-    return dict
-
-
-def get_all_image_region_confidence(pickle_file_directory, label):
-    pkl_file_list = get_pickle_file_list(pickle_file_directory)
-    all_computer_region_list = []
-    for file in pkl_file_list:
-        pickle_path = os.path.join(pickle_file_directory, file)
-        with open(pickle_path, 'rb') as f:
-            result = pickle.load(f)
-            computer_region_list = result[label]
-            all_computer_region_list += computer_region_list
-    all_confidence = [i[-1] for i in all_computer_region_list]
-    all_confidence = sorted(all_confidence)
-    return all_confidence
-
-
-def show_result(show_image, result_list, label_group, output_image_path, confidence_offset, x_scale):
+def show_result(show_image, result_list, label_group, output_image_path, confidence_offset, x_scale, report=None):
     # 每一个label_group一个图形
-    for group in label_group:
-        plt.figure(figsize=(12, 6))
-        plt.xlabel('confidence')
-        plt.yticks(np.arange(0, 1, 0.1))
-        plt.xticks(np.arange(confidence_offset, 1, x_scale))
-
-        for label in group:
-            result = {}
-            for i in result_list:
-                if i['label'] == label:
-                    result = i
-                    break
-            if not result:
-                continue
-            f1_label = result['label'] + ': F1'
-            precision_label = result['label'] + ': precision'
-            recall_label = result['label'] + ': recall'
-            plt.plot(result['confidence_list'], result['precision_list'], color=result['color'], linestyle='solid',
-                     label=precision_label)
-            plt.plot(result['confidence_list'], result['recall_list'], color=result['color'], linestyle='dotted',
-                     label=recall_label)
-            plt.plot(result['confidence_list'], result['F1_list'], color=result['color'], linestyle='-.',
-                     label=f1_label)
-        plt.legend(loc=0)
-        if (show_image):
+    if show_image:
+        # 交互显示时才导入pyplot
+        import matplotlib.pyplot as plt
+        report_config = get_report_config(report)
+        result_dict = {result['label']: downsample_result(result, report_config['max_points'])
+                       for result in result_list}
+        for group in label_group:
+            plot_group(plt, group, result_dict, confidence_offset, x_scale)
             plt.show()
-        else:
-            date = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-            file_name = '{}-{}.png'.format(date, random.random())
-            save_path = os.path.join(output_image_path, file_name)
-            plt.savefig(save_path, dpi=300)
-
-
-def get_pickle_file_list(pickle_directory):
-    pickle_file_list = []
-    for root, dirs, files in os.walk(pickle_directory):
-        for file in files:
-            if file.split('.')[-1].lower() == 'pkl':
-                pickle_file_list.append(file)
-    return pickle_file_list
-
-
-def get_coincide_region_num(current_region_list, doctor_region_list):
-    if len(doctor_region_list) == 0 and len(current_region_list) != 0:
-        TP1, TP2, FN = 0, 0, 0
-        FP = len(current_region_list) - 0
-        return TP1, TP2, FP, FN
-    if (len(doctor_region_list), len(current_region_list)) == (0, 0):
-        return 0, 0, 0, 0
-    if len(doctor_region_list) != 0 and len(current_region_list) == 0:
-        TP1, TP2, FP = 0, 0, 0
-        FN = len(doctor_region_list)
-        return TP1, TP2, FP, FN
-
-    gt_bbox = np.array(doctor_region_list)
-    mc_bbox = np.array(current_region_list).reshape((-1, 1, 5))[:, :, :4]
-    xmin = np.maximum(gt_bbox[:, 0], mc_bbox[:, :, 0])
-    ymin = np.maximum(gt_bbox[:, 1], mc_bbox[:, :, 1])
-    xmax = np.minimum(gt_bbox[:, 2], mc_bbox[:, :, 2])
-    ymax = np.minimum(gt_bbox[:, 3], mc_bbox[:, :, 3])
-    w = np.maximum(xmax - xmin, 0.)
-    h = np.maximum(ymax - ymin, 0.)
-    inter = w * h
-    inter_check = np.where(inter > 0, 1, 0)
-    tp_array_1 = np.sum(inter_check, axis=1)
-    tp_array_1 = np.where(tp_array_1 > 0, 1, 0)
-    TP1 = np.sum(tp_array_1)
-
-    TP2 = np.sum(inter_check, axis=0)
-    TP2 = np.where(TP2 > 0, 1, 0)
-    TP2 = np.sum(TP2)
-    FP = len(current_region_list) - TP1
-    FN = len(doctor_region_list) - TP2
-    return TP1, TP2, FP, FN
-
-
-def handle_result(computer_region_list, doctor_region_list, init_confidence):
-    # 根据置信度排序
-    sorted_all_regions = sorted(computer_region_list, key=lambda x: x[-1])
-    current_region_list = []
-    for index, region in enumerate(sorted_all_regions):
-        if region[-1] >= init_confidence:
-            current_region_list = sorted_all_regions[index:]
-            break
-    TP1, TP2, FP, FN = get_coincide_region_num(current_region_list, doctor_region_list)
-    return TP1, TP2, FP, FN
+    else:
+        # 非交互的Agg后端, 多个group并行生成, 文件名由label决定
+        for save_path in render_report(result_list, label_group, output_image_path, confidence_offset, x_scale,
+                                       report):
+            print('保存 {}'.format(save_path))
 
 
 def calc_precision(TP, FP):
@@ -286,43 +178,22 @@ def trim_label_group(need_label_group, pkl_label_set, group_size):
         return set(label_list), need_label_group
 
 
-def get_all_pkl_label(pickle_file_directory, pkl_file_list):
-    label_list = []
-    for file in pkl_file_list:
-        pkl_path = os.path.join(pickle_file_directory, file)
-        with open(pkl_path, 'rb') as f:
-            result = pickle.load(f)
-            for k, v in result.items():
-                label_list.append(k)
-    return set(label_list)
-
-
-def save_cache_as_pkl(save_directory, result, label):
-    if save_directory:
-        file_name = '{}.pkl'.format(label)
-        file_path = os.path.join(save_directory, file_name)
-        with open(file_path, 'wb') as f:
-            pickle.dump(result, f)
-
-
 def calc_ap_by_precision_recall(result):
-    precision_list = result['precision_list']
-    recall_list = result['recall_list']
-    mrec = np.concatenate(([0.], precision_list, [1.]))
-    mpre = np.concatenate(([0.], recall_list, [0.]))
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
-    i = np.where(mrec[1:] != mrec[:-1])[0]
+    return calc_ap_by_precision_recall_batch([result])[0]
 
-    # sum (\delta recall) * prec
-    ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
-    return ap
+
+def calc_ap_by_precision_recall_batch(result_list):
+    # 与原实现一致, 以precision_list作为积分的横轴、recall_list作为纵轴
+    precision_lists = [result['precision_list'] for result in result_list]
+    recall_lists = [result['recall_list'] for result in result_list]
+    return batch_average_precision(precision_lists, recall_lists)
 
 
 def parse_arg():
     parser = argparse.ArgumentParser()
     parser.add_argument('yml_path', type=str, help='path to pkl_files')
-    args = parser.parse_args()
+    # 先只读取yml路径, yml中的参数可在命令行覆盖, 如 --shard_index 3
+    args, _ = parser.parse_known_args()
     yml_file = open(args.yml_path, encoding='utf-8')
     param_dict = yaml.safe_load(yml_file)
     for item in param_dict:
@@ -331,6 +202,121 @@ def parse_arg():
     return args
 
 
+def get_rule_label(label, match_rule):
+    # 默认匹配规则的结果使用原label, 其它规则为 label@规则名, 如 hsil@iou0.5
+    rule_name = get_match_rule_name(match_rule)
+    return '{}@{}'.format(label, rule_name) if rule_name else label
+
+
+def get_run_inputs_fingerprint(args, pkl_file_list, xml_region_index):
+    # 曲线cache按输入文件、label与计算规则寻址, 只需要文件的stat, 不读取内容
+    if args.detection_store:
+        store_directory, store_file = os.path.split(os.path.abspath(args.detection_store))
+        pkl_stat_list = get_file_stat_list(store_directory, [store_file])
+    else:
+        pkl_stat_list = get_file_stat_list(args.pkl_file_directory, pkl_file_list)
+    return get_inputs_fingerprint(pkl_stat_list, xml_region_index.file_stat_list())
+
+
+def get_match_rule_list(args):
+    # 默认的任意相交规则之外, 每个匹配规则再输出一条曲线
+    return [None] + [get_match_rule(rule) for rule in args.match_rules]
+
+
+def get_cached_results(args, curve_cache, inputs_fingerprint, need_label_set):
+    """
+    :return: 每条曲线的cache key {(label, 规则名): key}, 以及其中已有cache的结果 {(label, 规则名): result}
+    """
+    cache_key_dict, cached_result_dict = {}, {}
+    for label in need_label_set:
+        for match_rule in get_match_rule_list(args):
+            rules = {'threshold_grid': args.threshold_grid, 'bootstrap': args.bootstrap, 'froc': args.froc,
+                     'slide_level': args.slide_level, 'match_rule': get_match_rule(match_rule),
+                     'dedup_rules': args.dedup['rules']}
+            key = (label, get_match_rule_name(match_rule))
+            cache_key_dict[key] = get_curve_cache_key(inputs_fingerprint, label, args.confidence_offset, rules)
+            cached_result = curve_cache.get(cache_key_dict[key])
+            if cached_result is not None:
+                cached_result_dict[key] = cached_result
+    return cache_key_dict, cached_result_dict
+
+
+def load_all_cached_results(args, curve_cache, inputs_fingerprint, label_filter, need_label_group):
+    """
+    所有曲线都有cache时直接读取, 不需要读取pkl
+    :param label_filter: 读取pkl时只保留的label, 与label集合的cache key对应
+    :return: pkl中的label集合与结果列表, label集合或任一曲线没有cache时为None, None
+    """
+    cached_labels = curve_cache.get(get_label_set_cache_key(inputs_fingerprint, label_filter))
+    if cached_labels is None:
+        return None, None
+    pkl_label_set = set(cached_labels['labels'])
+    need_label_set, _ = trim_label_group(need_label_group, pkl_label_set, args.group_size)
+    cache_key_dict, cached_result_dict = get_cached_results(args, curve_cache, inputs_fingerprint, need_label_set)
+    if len(cached_result_dict) < len(cache_key_dict):
+        return None, None
+    result_list = []
+    for key in cache_key_dict:
+        print('读取cache {}'.format(cached_result_dict[key]['label']))
+        result_list.append(cached_result_dict[key])
+    return pkl_label_set, result_list
+
+
+def calc_result_list(args, slide_catalog, xml_region_index, need_label_set, curve_cache, inputs_fingerprint):
+    match_rule_list = get_match_rule_list(args)
+    cache_key_dict, cached_result_dict = get_cached_results(args, curve_cache, inputs_fingerprint, need_label_set)
+    uncached_label_set = set(label for label, _ in set(cache_key_dict.keys()) - set(cached_result_dict.keys()))
+
+    label_overlap_dict = {}
+    if args.all_labels_at_once:
+        # 每张slide只访问一次, 同时得到所有未缓存label的相交结果
+        label_overlap_dict = build_label_overlaps(slide_catalog, xml_region_index, uncached_label_set, args.processes)
+
+    result_list = []
+    for label in need_label_set:
+        for match_rule in match_rule_list:
+            key = (label, get_match_rule_name(match_rule))
+            # 读取已保存的cache文件
+            if key in cached_result_dict:
+                print('读取cache {}'.format(get_rule_label(label, match_rule)))
+                result = cached_result_dict[key]
+            # 计算result
+            else:
+                if label not in label_overlap_dict:
+                    label_overlap_dict[label] = LabelOverlap.from_results(
+                        slide_catalog.results, slide_catalog.pkl_file_list,
+                        xml_region_index.regions_of_label(label), label)
+                # 不同匹配规则共用一次相交与IoU计算
+                label_overlap = label_overlap_dict[label]
+                if match_rule is not None:
+                    label_overlap = label_overlap.with_rule(match_rule)
+                result = for_each_pickle_file(slide_catalog, xml_region_index, label, args.confidence_offset,
+                                              label_overlap, args.threshold_grid, args.bootstrap, args.froc,
+                                              args.slide_level)
+                result['label'] = get_rule_label(label, match_rule)
+                result['base_label'] = label
+                curve_cache.put(cache_key_dict[key], result)
+            result_list.append(result)
+    return result_list
+
+
+def calc_operating_points(args, queries, slide_catalog=None, xml_region_index=None, slide_histogram_store=None):
+    # 只对查询中出现的label计算相交, 每个条件用二分查找得到阈值
+    labels = set(query['label'] for query in queries)
+    if slide_histogram_store is not None:
+        solver_dict = {label: OperatingPointSolver.from_counts(*slide_histogram_store.counts(label))
+                       for label in labels & slide_histogram_store.labels}
+    else:
+        label_overlap_dict = build_label_overlaps(slide_catalog, xml_region_index, labels & slide_catalog.labels,
+                                                  args.processes)
+        solver_dict = {label: OperatingPointSolver.from_label_overlap(label_overlap, args.confidence_offset)
+                       for label, label_overlap in label_overlap_dict.items()}
+    answer_list = solve_operating_points(solver_dict, queries)
+    for answer in answer_list:
+        print(format_operating_point(answer))
+    return answer_list
+
+
 if __name__ == '__main__':
     args = parse_arg()
     pickle_file_directory = args.pkl_file_directory
@@ -342,34 +328,122 @@ if __name__ == '__main__':
 
     start_time = time.time()
 
-    pkl_file_list = get_pickle_file_list(pickle_file_directory)
-    pkl_label_set = get_all_pkl_label(pickle_file_directory, pkl_file_list)
+    shard_mode = args.shard_mode
+    if shard_mode not in ('', 'map', 'merge'):
+        raise Exception('Unknown shard_mode {}'.format(shard_mode))
+    # 增量模式与分片模式只保存默认匹配规则的直方图
+    if args.match_rules and (args.incremental['directory'] or shard_mode):
+        raise Exception('match_rules is not supported in incremental or shard mode')
+    # 合并分片只需要分片目录, 不读取pkl和xml
+    if shard_mode != 'merge':
+        # 所有医生xml只解析一次, 未修改的xml直接从cache读取; 分片只解析本分片slide的xml
+        xml_file_filter = None
+        if shard_mode == 'map':
+            check_shard(args.shard_index, args.shard_count)
+            xml_file_filter = get_shard_filter(args.shard_index, args.shard_count)
+        xml_region_index = XmlRegionIndex(xml_file_directory, args.xml_cache_path, xml_file_filter)
+        print('解析xml {}/{}'.format(xml_region_index.parsed_num, len(xml_region_index.regions)))
+
+    if shard_mode == 'map':
+        # 只计算本分片的slide直方图, 曲线由merge统一输出
+        _, changed_num, removed_num = run_shard(args.shard_directory, args.shard_index, args.shard_count,
+                                                pickle_file_directory, xml_region_index, confidence_offset,
+                                                args.incremental['step'], args.load_workers, args.load_memory_mb,
+                                                args.dedup)
+        print('分片 {}/{}: 更新slide {}, 删除slide {}'.format(args.shard_index, args.shard_count, changed_num,
+                                                         removed_num))
+        print('总用时{}s'.format(time.time() - start_time))
+        sys.exit(0)
+
+    incremental_directory = args.incremental['directory']
+    if shard_mode == 'merge':
+        # 合并后与增量模式相同, 由直方图得到阈值轴上的计数
+        slide_histogram_store = ShardedHistogramStore(args.shard_directory, args.shard_count, confidence_offset,
+                                                      args.incremental['step'], args.dedup['rules'])
+        print('合并分片 {}, slide {}'.format(args.shard_count, len(slide_histogram_store.manifest)))
+        pkl_label_set = slide_histogram_store.labels
+    elif incremental_directory:
+        # 增量模式: 只读取新增或修改过的pkl, 在保存的直方图上更新
+        slide_histogram_store = SlideHistogramStore(incremental_directory, confidence_offset,
+                                                    args.incremental['step'], args.dedup['rules'])
+        changed_num, removed_num = slide_histogram_store.update(pickle_file_directory, xml_region_index,
+                                                                args.load_workers, args.load_memory_mb, args.dedup)
+        print('更新slide {}, 删除slide {}'.format(changed_num, removed_num))
+        pkl_label_set = slide_histogram_store.labels
+    else:
+        curve_cache = CurveCache(args.cache_directory, args.cache_max_size_mb)
+        need_labels, pkl_file_list = None, None
+        if not args.detection_store:
+            pkl_file_list = get_pickle_file_list(pickle_file_directory)
+            # 流式读取时只保留需要的label(label_group与工作点查询中的label)
+            if need_label_group:
+                need_labels = set(label for group in need_label_group for label in group)
+                need_labels.update(query['label'] for query in args.operating_points['queries'])
+        inputs_fingerprint = get_run_inputs_fingerprint(args, pkl_file_list, xml_region_index)
+        cached_result_list = None
+        if not args.operating_points['queries']:
+            # 所有曲线都已有cache时不读取pkl
+            pkl_label_set, cached_result_list = load_all_cached_results(args, curve_cache, inputs_fingerprint,
+                                                                        need_labels, need_label_group)
+        if cached_result_list is None:
+            # 每个pkl只读取一次, 之后所有label的计算都使用slide_catalog
+            if args.detection_store:
+                # 读取detection_store.py打包的文件, 框以内存映射的float32数组给出
+                slide_catalog = SlideCatalog.from_store(DetectionStore(args.detection_store))
+            else:
+                # 流式读取, 只保留需要的label以及 >= confidence_offset 的框
+                slide_catalog = SlideCatalog.from_pickle_directory(pickle_file_directory, args.load_workers,
+                                                                   pkl_file_list, labels=need_labels,
+                                                                   min_confidence=confidence_offset,
+                                                                   max_memory_mb=args.load_memory_mb,
+                                                                   dedup=args.dedup)
+            pkl_label_set = slide_catalog.labels
+            curve_cache.put(get_label_set_cache_key(inputs_fingerprint, need_labels),
+                            {'labels': sorted(pkl_label_set)})
     print(pkl_label_set)
 
+    # 增量模式与分片合并都由直方图计算
+    histogram_mode = bool(incremental_directory) or shard_mode == 'merge'
+    operating_point_queries = args.operating_points['queries']
+    if operating_point_queries:
+        if histogram_mode:
+            calc_operating_points(args, operating_point_queries, slide_histogram_store=slide_histogram_store)
+        else:
+            calc_operating_points(args, operating_point_queries, slide_catalog, xml_region_index)
+        if args.operating_points['only']:
+            print('总用时{}s'.format(time.time() - start_time))
+            sys.exit(0)
+
     # 根据label分类
     need_label_set, need_label_group = trim_label_group(need_label_group, pkl_label_set, args.group_size)
-    all_pkl_result_dict = get_all_pkl_result_dict(pickle_file_directory, pkl_file_list)
-    result_list = []
-    for label in need_label_set:
-        # 读取已保存的cache文件
-        input_cache_directory = args.input_cache_directory
-        if input_cache_directory and ((label + '.pkl') in os.listdir(input_cache_directory)):
-            file_path = os.path.join(input_cache_directory, label + '.pkl')
-            with open(file_path, 'rb') as f:
-                print('读取 {}.pkl'.format(label))
-                result = pickle.load(f)
-        # 计算result
-        else:
-            result = for_each_pickle_file(pickle_file_directory, xml_file_directory, label, confidence_offset,
-                                          all_pkl_result_dict)
-            label_color = label_color_dict[label]
-            result['color'] = label_color
-            save_cache_as_pkl(args.save_cache_directory, result, label)
-        result_list.append(result)
-        ap = calc_ap_by_precision_recall(result)
-        print('ap值   {}: {}'.format(label, ap))
+    if not histogram_mode:
+        # 每个匹配规则的曲线单独成组画图
+        need_label_group = need_label_group + [[get_rule_label(label, rule) for label in group]
+                                               for rule in args.match_rules for group in need_label_group]
+    if histogram_mode:
+        result_list = [for_each_label_histogram(slide_histogram_store, label, args.bootstrap, args.froc,
+                                                args.slide_level)
+                       for label in need_label_set]
+    elif cached_result_list is not None:
+        result_list = cached_result_list
+    else:
+        result_list = calc_result_list(args, slide_catalog, xml_region_index, need_label_set, curve_cache,
+                                       inputs_fingerprint)
+
+    # 所有label的AP一次计算
+    ap_list = calc_ap_by_precision_recall_batch(result_list)
+    for result, ap in zip(result_list, ap_list):
+        result['color'] = label_color_dict[result.get('base_label', result['label'])]
+        result['ap'] = ap
+        print('ap值   {}: {}'.format(result['label'], ap))
+        print('froc   {}: {}'.format(result['label'], result['froc_score']))
+        if 'slide_auc' in result:
+            print('slide auc   {}: {}'.format(result['label'], result['slide_auc']))
     # 展现结果
     show_image = args.show_image
     output_image_path = args.output_image_path
-    show_result(show_image, result_list, need_label_group, output_image_path, confidence_offset, x_scale)
+    # 曲线数据另存, 供其它程序直接读取
+    for save_path in export_curves(result_list, output_image_path, args.report['formats']):
+        print('保存 {}'.format(save_path))
+    show_result(show_image, result_list, need_label_group, output_image_path, confidence_offset, x_scale, args.report)
     print('总用时{}s'.format(time.time() - start_time))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+置信度阈值网格
+
+mode:
+    exact:    使用所有 >= confidence_offset 的置信度(含重复值), 与原实现一致
+    step:     从confidence_offset开始按固定步长取阈值
+    quantile: 按分位数(即按排名等间隔)取quantiles个实际出现过的置信度
+    budget:   不同置信度个数不超过max_points时全部使用, 否则按分位数取max_points个
+refine为True时, 在粗网格上找到F1最大值以及target_precision/target_recall所在的区间,
+再把区间内所有实际出现过的置信度加入网格精确计算
+"""
+import numpy as np
+
+DEFAULT_THRESHOLD_GRID = {
+    'mode': 'exact',
+    'step': 0.001,
+    'quantiles': 200,
+    'max_points': 500,
+    'refine': False,
+    'target_precision': [],
+    'target_recall': [],
+}
+
+
+def get_grid_config(threshold_grid):
+    grid_config = dict(DEFAULT_THRESHOLD_GRID)
+    grid_config.update(threshold_grid or {})
+    if grid_config['mode'] not in ('exact', 'step', 'quantile', 'budget'):
+        raise Exception('Unknown threshold_grid mode {}'.format(grid_config['mode']))
+    return grid_config
+
+
+def _rank_grid(unique_confidence, point_num):
+    if len(unique_confidence) <= point_num:
+        return unique_confidence
+    index = np.round(np.linspace(0, len(unique_confidence) - 1, point_num)).astype(np.int64)
+    return unique_confidence[np.unique(index)]
+
+
+def build_threshold_grid(sorted_confidence_list, confidence_offset, threshold_grid=None):
+    """
+    :param sorted_confidence_list: >= confidence_offset 的置信度, 升序
+    :param threshold_grid: speculate_confidence.yml中的--threshold_grid
+    :return: 升序的阈值数组
+    """
+    grid_config = get_grid_config(threshold_grid)
+    mode = grid_config['mode']
+    if mode == 'exact' or len(sorted_confidence_list) == 0:
+        return sorted_confidence_list
+    if mode == 'step':
+        step = grid_config['step']
+        point_num = int(np.floor((sorted_confidence_list[-1] - confidence_offset) / step)) + 1
+        return confidence_offset + step * np.arange(point_num)
+    unique_confidence = np.unique(sorted_confidence_list)
+    if mode == 'quantile':
+        return _rank_grid(unique_confidence, grid_config['quantiles'])
+    return _rank_grid(unique_confidence, grid_config['max_points'])
+
+
+def _crossing_index(metric_list, target):
+    # 相邻两点分别位于target两侧(或等于target)的位置
+    diff = np.asarray(metric_list, dtype=np.float64) - target
+    return np.where(diff[:-1] * diff[1:] <= 0)[0]
+
+
+def refine_threshold_grid(grid, sorted_confidence_list, precision_list, recall_list, F1_list, threshold_grid=None):
+    """
+    在F1最大值及目标precision/recall附近加入所有实际置信度
+    :param grid: 粗网格
+    :param sorted_confidence_list: >= confidence_offset 的置信度, 升序
+    :return: 加密后的网格, 没有需要加密的区间时返回原网格
+    """
+    grid_config = get_grid_config(threshold_grid)
+    if not grid_config['refine'] or grid_config['mode'] == 'exact' or len(grid) < 2:
+        return grid
+
+    interval_list = []
+    best = int(np.argmax(F1_list))
+    interval_list.append((grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]))
+    for metric_list, target_list in ((precision_list, grid_config['target_precision']),
+                                     (recall_list, grid_config['target_recall'])):
+        for target in target_list:
+            for index in _crossing_index(metric_list, target):
+                interval_list.append((grid[index], grid[index + 1]))
+
+    refine_list = [grid]
+    for low, high in interval_list:
+        start = np.searchsorted(sorted_confidence_list, low, side='left')
+        end = np.searchsorted(sorted_confidence_list, high, side='right')
+        refine_list.append(sorted_confidence_list[start:end])
+    return np.unique(np.concatenate(refine_list))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+医生标注xml索引: 每个xml只解析一次, 同时取出所有label的框,
+并按(文件路径, mtime, size)缓存到磁盘, 下次运行只重新解析新增或修改过的xml
+"""
+import os
+import pickle
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+EMPTY_REGIONS = np.zeros((0, 4), dtype=np.float64)
+
+
+def parse_xml_all_labels(xml_path):
+    """
+    :return: {label: np.array([[x1, y1, x2, y2], ...])}
+    """
+    root = ET.parse(xml_path)
+    label_regions = {}
+    for obj in root.findall('object'):
+        label = obj.find('name').text
+        bbox_doc = obj.find('bndbox')
+        x1 = float(bbox_doc.find('xmin').text)
+        y1 = float(bbox_doc.find('ymin').text)
+        x2 = float(bbox_doc.find('xmax').text)
+        y2 = float(bbox_doc.find('ymax').text)
+        label_regions.setdefault(label, []).append([x1, y1, x2, y2])
+    return {label: np.array(regions, dtype=np.float64) for label, regions in label_regions.items()}
+
+
+def get_xml_file_list(xml_file_directory):
+    xml_file_list = []
+    for file in os.listdir(xml_file_directory):
+        if file.split('.')[-1].lower() == 'xml':
+            xml_file_list.append(file)
+    return xml_file_list
+
+
+class XmlRegionIndex:
+    """
+    regions: {file_name: {label: np.array}}, file_name与原实现一致为xml文件名'.'之前的部分
+    """
+
+    def __init__(self, xml_file_directory, cache_path='', file_filter=None):
+        """
+        :param file_filter: 不为None时只解析file_filter(xml_file)为True的xml, 如分片模式下属于本分片的slide
+        """
+        self.xml_file_directory = xml_file_directory
+        self.cache_path = cache_path
+        self.file_filter = file_filter
+        self.regions = {}
+        # {xml_path: (mtime, size, label_regions)}
+        self.file_records = {}
+        self.parsed_num = 0
+        self._build()
+
+    def _load_cache(self):
+        if self.cache_path and os.path.isfile(self.cache_path):
+            with open(self.cache_path, 'rb') as f:
+                return pickle.load(f)
+        return {}
+
+    def _save_cache(self, other_records):
+        if self.cache_path:
+            records = dict(other_records)
+            records.update(self.file_records)
+            # 多个进程可能同时读写同一个cache, 先写临时文件再替换, 读到的总是完整的cache
+            tmp_path = self.cache_path + '.tmp.{}'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+
+    def _build(self):
+        cached_records = self._load_cache()
+        directory = os.path.abspath(self.xml_file_directory)
+        xml_file_list = get_xml_file_list(self.xml_file_directory)
+        if self.file_filter is not None:
+            xml_file_list = [xml_file for xml_file in xml_file_list if self.file_filter(xml_file)]
+        # 同一个cache文件可以被多个xml目录共用, 过滤掉的xml(如其它分片的)也原样保留
+        other_records = {k: v for k, v in cached_records.items()
+                         if os.path.dirname(k) != directory or
+                         (self.file_filter is not None and not self.file_filter(os.path.basename(k)))}
+        for xml_file in xml_file_list:
+            xml_path = os.path.abspath(os.path.join(self.xml_file_directory, xml_file))
+            stat = os.stat(xml_path)
+            record = cached_records.get(xml_path)
+            if record is None or record[:2] != (stat.st_mtime, stat.st_size):
+                record = (stat.st_mtime, stat.st_size, parse_xml_all_labels(xml_path))
+                self.parsed_num += 1
+            self.file_records[xml_path] = record
+            self.regions[xml_file.split('.')[0]] = record[2]
+        # 有新解析的文件或有xml被删除时才重写cache
+        if self.parsed_num or len(cached_records) != len(other_records) + len(self.file_records):
+            self._save_cache(other_records)
+
+    def file_stat_list(self):
+        """
+        :return: [(xml_file, mtime, size), ...], 用于result_cache的key
+        """
+        return sorted((os.path.basename(path), record[0], record[1]) for path, record in self.file_records.items())
+
+    @property
+    def labels(self):
+        label_set = set()
+        for label_regions in self.regions.values():
+            label_set.update(label_regions.keys())
+        return label_set
+
+    def regions_of_label(self, target_label):
+        """
+        :return: {'file1': np.array, 'file2': np.array, ...}, 没有该label的文件对应空数组
+        """
+        return {file_name: label_regions.get(target_label, EMPTY_REGIONS)
+                for file_name, label_regions in self.regions.items()}